@@ -0,0 +1,93 @@
+"""
+Benchmark of loading a task's elements from the pickles versus the memory-mapped Arrow files.
+
+Writes a synthetic element with the given number of questions (four options each) to a temporary directory, converts
+it with convert_element_dir, and reports the startup time of a run on each format: load_dfs followed by building the
+ElementStore every evaluation indexes the frames with, timed together and separately.
+
+Usage:
+    python benchmarks/element_load_benchmark.py [--num-questions 1000000] [--repeats 3]
+"""
+
+# Built-in packages
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# External packages
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local packages
+from utils.arrow_utils import convert_element_dir, get_arrow_paths
+from utils.element_utils import ElementStore
+from utils.utils import load_dfs
+
+NUM_OPTIONS = 4
+
+
+def write_element(task_path, num_questions):
+    question_ids = [f'{i}_0' for i in range(num_questions)]
+    option_question_ids = np.repeat(question_ids, NUM_OPTIONS)
+    option_ids = np.tile(np.arange(NUM_OPTIONS), num_questions)
+    pd.DataFrame({
+        'question_id': question_ids,
+        'question_text': [f'Question {i}: which of the following options is correct?' for i in range(num_questions)],
+        'explanation': [f'Because {i}' if i % 10 == 0 else False for i in range(num_questions)],
+    }).to_pickle(os.path.join(task_path, 'questions.pkl'))
+    pd.DataFrame({
+        'question_id': question_ids,
+        'type': np.array(['type_a', 'type_b'])[np.arange(num_questions) % 2],
+        'domain': np.array(['domain_a', 'domain_b', 'domain_c'])[np.arange(num_questions) % 3],
+        'difficulty_level': np.arange(num_questions) % 5,
+    }).to_pickle(os.path.join(task_path, 'questions_metadata.pkl'))
+    pd.DataFrame({
+        'question_id': option_question_ids,
+        'option_id': option_ids,
+        'option_text': [f'Option {option_id} of question {i // NUM_OPTIONS}' for i, option_id in enumerate(option_ids)],
+    }).to_pickle(os.path.join(task_path, 'options.pkl'))
+    pd.DataFrame({
+        'question_id': option_question_ids,
+        'option_id': option_ids,
+        'correct_answer': (option_ids == 0).astype(int),
+    }).to_pickle(os.path.join(task_path, 'answers.pkl'))
+
+
+def time_load(task_path, repeats):
+    """
+    Returns the load and store build times in seconds of the fastest of repeats startups.
+    """
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        dfs = load_dfs(task_path)
+        load_time = time.perf_counter() - start_time
+        ElementStore(*dfs)
+        times.append((time.perf_counter() - start_time, load_time))
+    total_time, load_time = min(times)
+    return load_time, total_time - load_time
+
+
+def main(num_questions, repeats):
+    with tempfile.TemporaryDirectory() as task_path:
+        task_path = task_path + '/'
+        write_element(task_path, num_questions)
+        pickle_times = time_load(task_path, repeats)
+        convert_element_dir(task_path)
+        arrow_times = time_load(task_path, repeats)
+        arrow_bytes = sum(os.path.getsize(path) for path in get_arrow_paths(task_path))
+    print(f'{num_questions} questions ({arrow_bytes / 1e6:.1f} MB mapped as Arrow), load_dfs + ElementStore:')
+    for name, (load_time, store_time) in [('pickle', pickle_times), ('arrow', arrow_times)]:
+        print(f'  {name}: {(load_time + store_time) * 1e3:.1f} ms (load {load_time * 1e3:.1f} ms, store {store_time * 1e3:.1f} ms)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Element load benchmark')
+    parser.add_argument('--num-questions', type=int, default=1000000, help="Number of questions in the synthetic element")
+    parser.add_argument('--repeats', type=int, default=3, help="Startups timed per format; the fastest is reported")
+    args = parser.parse_args()
+    main(args.num_questions, args.repeats)
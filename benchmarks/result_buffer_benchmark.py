@@ -0,0 +1,82 @@
+"""
+Microbenchmark of the per-question cost of accumulating evaluation results.
+
+Compares the ResultBuffer used by eval_models against the previous approach of concatenating a one-question DataFrame
+onto the growing results DataFrame. For every run size, the average time to add one question is reported; with the
+buffer it should stay flat from 100 to 100k questions, while concatenation grows linearly with the number of results.
+
+Usage:
+    python benchmarks/result_buffer_benchmark.py [--sizes 100 1000 10000 100000] [--max-concat 10000]
+"""
+
+# Built-in packages
+import argparse
+import os
+import sys
+import time
+
+# External packages
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Local packages
+from utils.dataset_utils import ResultBuffer
+
+
+def make_record(i):
+    return {
+        'num_shots': 0,
+        'allow_explanation': False,
+        'question_type': 'mc',
+        'domain': 'domain',
+        'difficulty_level': i % 5,
+        'type': 'type',
+        'task_name': 'benchmark',
+        'model': 'model',
+        'question_id': f'{i}_0',
+        'permuted_answer': i % 4,
+        'model_answer': 'A',
+        'model_explanation': '',
+        'probabilities': {'A': 0.4, 'B': 0.3, 'C': 0.2, 'D': 0.1},
+        'accuracy': True,
+        'normalized_accuracy': 0.75,
+        'expected_calibration': 0.1,
+    }
+
+
+def time_buffer(num_questions):
+    records = [make_record(i) for i in range(num_questions)]
+    start_time = time.perf_counter()
+    results_buffer = ResultBuffer()
+    for record in records:
+        results_buffer.extend([record])
+    results_df = results_buffer.to_frame()
+    assert len(results_df) == num_questions
+    return (time.perf_counter() - start_time) / num_questions
+
+
+def time_concat(num_questions):
+    records = [make_record(i) for i in range(num_questions)]
+    start_time = time.perf_counter()
+    results_df = pd.DataFrame()
+    for record in records:
+        results_df = pd.concat([results_df, pd.DataFrame.from_records([record])], sort=False, ignore_index=True)
+    assert len(results_df) == num_questions
+    return (time.perf_counter() - start_time) / num_questions
+
+
+def main(sizes, max_concat):
+    print(f"{'questions':>10} {'buffer us/question':>20} {'concat us/question':>20}")
+    for num_questions in sizes:
+        buffer_time = time_buffer(num_questions) * 1e6
+        concat_time = f'{time_concat(num_questions) * 1e6:20.1f}' if num_questions <= max_concat else f"{'skipped':>20}"
+        print(f'{num_questions:>10} {buffer_time:20.1f} {concat_time}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Result accumulation benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000], help="Numbers of questions to time")
+    parser.add_argument('--max-concat', type=int, default=10000, help="Largest size to time pd.concat on, since it is quadratic")
+    args = parser.parse_args()
+    main(args.sizes, args.max_concat)
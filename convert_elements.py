@@ -0,0 +1,46 @@
+"""
+This script converts the element pickles of STEER tasks to the Arrow format read by load_dfs.
+
+For every task, questions.pkl, questions_metadata.pkl, options.pkl and answers.pkl are written next to the pickles as
+uncompressed Arrow IPC files, with question_id, domain, type and difficulty_level dictionary-encoded. Once the four
+.arrow files exist, load_dfs memory-maps them instead of unpickling, and worker processes share one copy of them in the
+page cache. Loading an element and building its ElementStore then takes about a third of the time it takes from the
+pickles (see benchmarks/element_load_benchmark.py). The pickles are left in place.
+
+Usage:
+    python convert_elements.py --task-name <task_name> [--elements-dir <elements_dir>]
+
+Arguments:
+    --task-name: The name of the task to convert. Use 'all' to convert all elements.
+    --elements-dir: Path to the directory where the elements database is kept. Default is 'elements/'.
+
+"""
+
+# Built-in packages
+import argparse
+import os
+import time
+
+# Local packages
+from utils.arrow_utils import convert_element_dir
+from utils.inference_utils import dir_path
+
+ELEMENTS_DIR = 'elements/'
+
+
+def main(task_names, elements_dir):
+    for task_name in task_names:
+        start_time = time.time()
+        paths = convert_element_dir(os.path.join(elements_dir, task_name))
+        print(f'Converted {task_name} in {time.time() - start_time:.2f}s: {", ".join(paths)}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Element conversion')
+    parser.add_argument('--task-name', '-t', type=str, help="Elements to convert")
+    parser.add_argument('--elements-dir', '-e', type=dir_path, nargs='?', default=ELEMENTS_DIR, help="Path to where the elements database is kept")
+    args = parser.parse_args()
+    if args.task_name == 'all':
+        main(next(os.walk(args.elements_dir))[1], args.elements_dir)
+    else:
+        main([args.task_name], args.elements_dir)
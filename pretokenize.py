@@ -0,0 +1,121 @@
+"""
+This script pre-tokenizes the prompts of local models into the token store of a configuration, so that evaluation reads
+token ids from memory-mapped files instead of running the tokenizer.
+
+Models whose tokenizers have the same fingerprint (vocabulary, chat template and chat format) share one store, so a
+task is tokenized once per tokenizer family rather than once per model. Every (task, family) pair is an independent job
+run in a worker process. The configuration needs the top-level `token_store` and `seed` keys (and `prefix_seed` for
+few-shot prompts), so that the prompts built here are the ones eval_models scores.
+
+Usage:
+    python pretokenize.py --task-name <task_name> [--elements-dir <elements_dir>] [--config-dir <config_dir>] [--max-workers <n>]
+
+Arguments:
+    --task-name: The name of the task(s) to pre-tokenize. Use 'all' to pre-tokenize all elements.
+    --elements-dir: Path to the directory where the elements database is kept. Default is 'elements/'.
+    --config-dir: Path to the directory where the configurations are kept. Default is 'configurations/'.
+    --max-workers: Upper bound on the number of worker processes. Default is the number of CPU cores.
+"""
+
+# Built-in packages
+import argparse
+import os
+import concurrent.futures
+import multiprocessing
+import time
+
+# Local packages
+from utils.inference_utils import dir_path, pretokenize_task
+from utils.cache_utils import TokenStore, tokenizer_fingerprint
+from utils.element_utils import ElementStore, EvaluationContext
+from utils.model_utils import MODEL_PATH, load_tokenizer
+from utils.utils import get_input_paths, read_as_defaultdict, load_dfs, get_chat_type
+
+CONFIG_DIR = 'configurations/'
+ELEMENTS_DIR = 'elements/'
+
+
+def get_tokenizer_families(config_path):
+    """
+    Groups the local models of a configuration by tokenizer fingerprint.
+
+    Returns:
+        dict: fingerprint -> names of the models sharing it. Models that cannot be found are left out.
+    """
+    args = read_as_defaultdict(config_path)
+    families = {}
+    for model_name in args['models']:
+        model_path = os.path.join(MODEL_PATH, model_name)
+        if not os.path.isdir(model_path):
+            print(f'Skipping model {model_name}. Cannot be found in {MODEL_PATH}.')
+            continue
+        fingerprint = tokenizer_fingerprint(load_tokenizer(model_path), get_chat_type(model_name))
+        families.setdefault(fingerprint, []).append(model_name)
+    return families
+
+
+def run_job(config_path, model_name):
+    """
+    Tokenizes the prompts of one task with the tokenizer of model_name into the store of its family.
+
+    Returns:
+        int, float: The number of prompts tokenized and the elapsed seconds.
+    """
+    start_time = time.time()
+    args = read_as_defaultdict(config_path)
+    context = EvaluationContext(args, ElementStore(*load_dfs(args['task_path'])))
+    tokenizer = load_tokenizer(os.path.join(MODEL_PATH, model_name))
+    chat_type = get_chat_type(model_name)
+    token_store = TokenStore(args['token_store'], tokenizer_fingerprint(tokenizer, chat_type))
+    num_prompts = pretokenize_task(context, tokenizer, chat_type, token_store)
+    token_store.close()
+    return num_prompts, time.time() - start_time
+
+
+def main(task_names, config_dir, max_workers=None):
+    """
+    Pre-tokenizes every task once per tokenizer family of its local models.
+
+    Args:
+        task_names (str or list): The name(s) of the task(s) to pre-tokenize.
+        config_dir (str): Path to the directory where the configurations are kept.
+        max_workers (int): Upper bound on the number of worker processes. Defaults to the number of CPU cores.
+    """
+    job_configs = get_input_paths(task_names=task_names, config_dir=config_dir)
+
+    jobs = []
+    for task_name, config_path in job_configs:
+        if not read_as_defaultdict(config_path)['token_store']:
+            print(f'Skipping {task_name}: its configuration has no token_store')
+            continue
+        for fingerprint, model_names in get_tokenizer_families(config_path).items():
+            print(f"Task {task_name}: tokenizer {fingerprint} shared by {', '.join(model_names)}")
+            jobs.append((task_name, config_path, model_names[0]))
+    if not jobs:
+        return
+
+    num_workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        future_to_job = {executor.submit(run_job, config_path, model_name): (task_name, model_name) for task_name, config_path, model_name in jobs}
+        for future in concurrent.futures.as_completed(future_to_job):
+            task_name, model_name = future_to_job[future]
+            try:
+                num_prompts, elapsed = future.result()
+                print(f'Task {task_name}: {num_prompts} prompts tokenized with the tokenizer of {model_name} in {elapsed:.1f}s')
+            except Exception as exc:
+                print(f'Task {task_name} failed with the tokenizer of {model_name}: {exc!r}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser('Pre-tokenize prompts')
+    parser.add_argument('--task-name', '-t', type=str, help="Elements to pre-tokenize")
+    parser.add_argument('--elements-dir', '-e', type=dir_path, nargs='?', default=ELEMENTS_DIR, help="Path to where the elements database is kept")
+    parser.add_argument('--config-dir', '-c', type=dir_path, nargs='?', default=CONFIG_DIR, help="Path to where the configurations are kept")
+    parser.add_argument('--max-workers', '-w', type=int, default=None, help="Upper bound on the number of worker processes")
+    args = parser.parse_args()
+    if args.task_name == 'all':
+        assert os.path.exists(args.elements_dir), 'Path to elements is not at current working directory, supply the directory with --elements-dir'
+        elements = next(os.walk(args.elements_dir))[1]
+        main(elements, args.config_dir, args.max_workers)
+    else:
+        main(args.task_name, args.config_dir, args.max_workers)
@@ -3,41 +3,204 @@ This script is used to run evaluations on a set of elements using the STEER benc
 It takes command-line arguments to specify the elements to evaluate, the directory where the elements database is kept,
 the directory where the configurations are kept, and whether to run inference on only API models.
 
-The script uses concurrent.futures to parallelize the evaluation process, utilizing all available CPU cores.
-For each task, it submits a job to the ThreadPoolExecutor, which runs the `run_evaluation` function on the input path.
-As each job completes, the result is printed.
+Local models are evaluated model-major. The elements of every task are loaded once, to find the tasks each model is
+still missing results for. Then the models are taken one at a time: a model is loaded, evaluated on each of its
+pending tasks in turn, and freed before the next model is loaded. Model weights are therefore read from disk once per
+run rather than once per task, and only one model is in memory at a time. Each task keeps one EvaluationContext for
+the whole run, so its stratified samples, few-shot prefixes and rendered prompts are shared by all of its models.
+
+For API models, each task runs in its own worker process, so the DataFrames a task loads and the pandas work of
+building prompts and scoring answers are isolated from the other tasks and not serialized by the GIL. The number of workers is sized by the
+memory available rather than by the number of cores: every task is estimated to need a fixed overhead plus a multiple
+of the size of its element files. Workers report a result dict per task (status, error and traceback), and a summary is
+printed once all tasks are done.
+
+The requests_per_minute and tokens_per_minute of every API deployment are enforced by one rate limiter per deployment,
+served by a manager process to all workers.
 
 If the `--task-name` argument is set to 'all', the script evaluates all elements in the elements database.
 Otherwise, it evaluates the specified task.
 
 Usage:
-    python run_script.py --task-name <task_name> [--element-dir <element_dir>] [--config-dir <config_dir>] [-api]
+    python run_script.py --task-name <task_name> [--elements-dir <elements_dir>] [--config-dir <config_dir>] [--max-workers <n>] [-api]
 
 Arguments:
     --task-name: The name of the task(s) to evaluate. Use 'all' to evaluate all elements.
-    --element-dir: Path to the directory where the elements database is kept. Default is 'elements/'.
+    --elements-dir: Path to the directory where the elements database is kept. Default is 'elements/'.
     --config-dir: Path to the directory where the configurations are kept. Default is 'configurations/'.
+    --max-workers: Upper bound on the number of API worker processes. Default is the number of CPU cores.
     -api: Flag that runs inference on only API models.
 
 """
 
 # Built-in packages
 import argparse
+import gc
 import os
+import sys
 import concurrent.futures
+import multiprocessing
+import time
+import traceback
 
 # External packages
-import pandas as pd
+import psutil
+import torch
 
 # Local packages
-from utils.inference_utils import dir_path, run_evaluation
-from utils.utils import get_input_paths
-from utils.logger_utils import JobLogger
+from utils.inference_utils import dir_path, run_evaluation, is_model_evaluated
+from utils.element_utils import ElementStore, EvaluationContext, StratificationIndex
+from utils.model_utils import MODEL_PATH, load_model_tokenizer, estimate_model_memory
+from utils.utils import get_input_paths, read_as_defaultdict, load_dfs
+import utils.rate_limit_utils as rate_limit_utils
+from utils.rate_limit_utils import RateLimitManager
 
 CONFIG_DIR = 'configurations/'
 ELEMENTS_DIR = 'elements/'
 
-def main(task_names, api, config_dir):
+# Memory a worker needs regardless of the task (interpreter, torch, transformers and the API clients)
+BASE_TASK_MEMORY = 2 * 1024 ** 3
+# Loaded DataFrames, the ElementStore index and the result buffers as a multiple of the size of the element files
+ELEMENT_MEMORY_FACTOR = 8
+
+
+def estimate_task_memory(config_path):
+    """
+    Estimates the peak memory in bytes of running a task from the size of the element files in its task_path.
+    """
+    task_path = read_as_defaultdict(config_path)['task_path']
+    element_bytes = 0
+    if task_path and os.path.isdir(task_path):
+        for root, _, files in os.walk(task_path):
+            element_bytes += sum(os.path.getsize(os.path.join(root, file)) for file in files)
+    return BASE_TASK_MEMORY + ELEMENT_MEMORY_FACTOR * element_bytes
+
+
+def get_num_workers(job_configs, max_workers=None):
+    """
+    Returns how many tasks can run side by side in the memory currently available, between 1 and max_workers.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    task_memory = max(estimate_task_memory(config_path) for _, config_path in job_configs)
+    num_workers = psutil.virtual_memory().available // task_memory
+    return int(max(1, min(num_workers, max_workers, len(job_configs))))
+
+
+def init_worker(registry):
+    rate_limit_utils.SHARED_REGISTRY = registry
+
+
+def run_task(task_name, config_path, api):
+    """
+    Runs the evaluation of one task and reports how it went instead of raising.
+
+    Returns:
+        dict: task_name, status ('completed' or 'failed'), error and traceback (None if completed), and the elapsed
+        seconds.
+    """
+    start_time = time.time()
+    try:
+        run_evaluation(config_path, api)
+        error, error_traceback = None, None
+    except Exception as exc:
+        error, error_traceback = repr(exc), traceback.format_exc()
+    return {
+        'task_name': task_name,
+        'status': 'completed' if error is None else 'failed',
+        'error': error,
+        'traceback': error_traceback,
+        'elapsed': time.time() - start_time,
+    }
+
+
+def fail_task(result, error, error_traceback=None):
+    """
+    Marks a task's result dict as failed, joining error and error_traceback to the ones already recorded.
+    """
+    result['status'] = 'failed'
+    result['error'] = '; '.join(filter(None, [result['error'], error]))
+    result['traceback'] = ''.join(filter(None, [result['traceback'], error_traceback]))
+
+
+def run_local_tasks(job_configs):
+    """
+    Evaluates the local models of every task model-major.
+
+    A model is only loaded if at least one task is missing results for it, and it is freed once it has been evaluated
+    on all of them. Which tasks are pending is decided from each task's StratificationIndex alone. A task's
+    ElementStore is built when its first model runs, and its EvaluationContext is then reused by every later model.
+    A task's result dict is 'failed' if any of its models failed or could not be loaded, with the errors and
+    tracebacks of those models joined.
+
+    Args:
+        job_configs (list): (task_name, config_path) pairs.
+
+    Returns:
+        list: The result dict of every task, as returned by run_task.
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    num_gpus = torch.cuda.device_count()
+    results = {task_name: {'task_name': task_name, 'status': 'completed', 'error': None, 'traceback': None, 'elapsed': 0.0} for task_name, _ in job_configs}
+
+    # The tasks missing results for each model. Every task's elements are loaded once and kept for its evaluation
+    pending = {}
+    task_elements = {}
+    contexts = {}
+    for task_name, config_path in job_configs:
+        start_time = time.time()
+        try:
+            args = read_as_defaultdict(config_path)
+            dfs = load_dfs(args['task_path'])
+            stratification_index = StratificationIndex(dfs[0], dfs[1])
+            task_elements[task_name] = (args, dfs, stratification_index)
+            for model_name in args['models']:
+                pending.setdefault(model_name, [])
+                if not is_model_evaluated(args, stratification_index, model_name):
+                    pending[model_name].append((task_name, config_path))
+        except Exception as exc:
+            fail_task(results[task_name], repr(exc), traceback.format_exc())
+        results[task_name]['elapsed'] += time.time() - start_time
+
+    for model_name, model_tasks in pending.items():
+        if not model_tasks:
+            print(f"Model {model_name} has already been evaluated on every task.")
+            continue
+        model_path = os.path.join(MODEL_PATH, model_name)
+        if os.path.isdir(model_path):
+            print(f"Loading model: {model_name} ({estimate_model_memory(model_path) / 1024 ** 3:.1f} GiB of weights)")
+            model, tokenizer = load_model_tokenizer(model_path, device, num_gpus)
+            error = 'could not be loaded'
+        else:
+            model, tokenizer = False, False
+            error = f'cannot be found in {MODEL_PATH}'
+        if not model:
+            print(f'Skipping model {model_name}: {error}')
+            for task_name, _ in model_tasks:
+                fail_task(results[task_name], f'{model_name}: {error}')
+            continue
+
+        print(f"Evaluating {model_name} on {len(model_tasks)} tasks")
+        for task_name, config_path in model_tasks:
+            start_time = time.time()
+            try:
+                if task_name not in contexts:
+                    args, dfs, stratification_index = task_elements[task_name]
+                    contexts[task_name] = EvaluationContext(args, ElementStore(*dfs), stratification_index)
+                run_evaluation(config_path, False, models={model_name: (model, tokenizer)}, model_names=[model_name], context=contexts[task_name])
+            except Exception as exc:
+                fail_task(results[task_name], f'{model_name}: {exc!r}', traceback.format_exc())
+            results[task_name]['elapsed'] += time.time() - start_time
+
+        # Free the model, including its CUDA memory, before the next one is loaded
+        del model, tokenizer
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    return list(results.values())
+
+
+def main(task_names, api, config_dir, max_workers=None):
     """
     Main function to run evaluations on a set of elements.
 
@@ -45,29 +208,52 @@ def main(task_names, api, config_dir):
         task_names (str or list): The name(s) of the task(s) to evaluate. Use 'all' to evaluate all elements.
         api (bool): Flag that runs inference on only API models.
         config_dir (str): Path to the directory where the configurations are kept.
+        max_workers (int): Upper bound on the number of API worker processes. Defaults to the number of CPU cores.
 
     Returns:
-        None
+        list: The result dict of every task, as returned by run_task.
     """
     job_configs = get_input_paths(task_names=task_names, config_dir=config_dir)
-    max_threads = os.cpu_count() or 1  # Use all available cores, default to 1 if not detected
 
-    if type(task_names) == str:
-        run_evaluation(job_configs[0][1], api)
+    if not api:
+        results = run_local_tasks(job_configs)
+    elif type(task_names) == str:
+        results = [run_task(job_configs[0][0], job_configs[0][1], api)]
     else:
+        num_workers = get_num_workers(job_configs, max_workers)
+        print(f'Running {len(job_configs)} tasks on {num_workers} worker processes')
+
+        results = []
+        # Every worker paces its API requests against the same per-deployment budgets
+        with RateLimitManager(ctx=multiprocessing.get_context('spawn')) as manager:
+            registry = manager.RateLimiterRegistry()
+            # Spawned workers start from a clean interpreter, which CUDA requires
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(registry,)
+            ) as executor:
+                # Submit all jobs to the executor
+                future_to_job = {executor.submit(run_task, task_name, config_path, api): task_name for task_name, config_path in job_configs}
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            # Submit all jobs to the executor
-            future_to_job = {executor.submit(run_evaluation, job_config[1], api): job_config[0] for job_config in job_configs}
+                # As each job completes, collect its result
+                for future in concurrent.futures.as_completed(future_to_job):
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        # The worker process itself died, e.g. it was killed for running out of memory
+                        result = {'task_name': future_to_job[future], 'status': 'failed', 'error': repr(exc), 'traceback': None, 'elapsed': None}
+                    print(f"Task {result['task_name']} {result['status']}" + (f": {result['error']}" if result['error'] else ''))
+                    results.append(result)
 
-            # As each job completes, get the result
-            for future in concurrent.futures.as_completed(future_to_job):
-                job_id = future_to_job[future]
-                try:
-                    result = future.result()
-                    print(f"Result of job {job_id}: {result}")
-                except Exception as exc:
-                    print(f"Job {job_id} generated an exception: {exc}")
+    failed = [result for result in results if result['status'] == 'failed']
+    print(f'{len(results) - len(failed)} of {len(results)} tasks completed')
+    for result in failed:
+        print(f"Task {result['task_name']} failed with {result['error']}")
+        if result['traceback']:
+            print(result['traceback'])
+    return results
 
 
 if __name__ == "__main__":
@@ -75,12 +261,15 @@ if __name__ == "__main__":
     parser.add_argument('--task-name', '-t', type=str, help="Elements to evaluate")
     parser.add_argument('--elements-dir', '-e', type=dir_path, nargs='?', default=ELEMENTS_DIR, help="Path to where the elements database is kept")
     parser.add_argument('--config-dir', '-c', type=dir_path, nargs='?', default=CONFIG_DIR, help="Path to where the configurations are kept")
+    parser.add_argument('--max-workers', '-w', type=int, default=None, help="Upper bound on the number of API worker processes")
     parser.add_argument('-api', action='store_true', help='Flag that runs inference on only api models')
     args = parser.parse_args()
     if args.task_name == 'all':
-        assert os.path.exists(args.element_dir), 'Path to elements is not at current working directory, supply the directory with --element-dir'
-        elements = next(os.walk(args.element_dir))[1]
-        job_loggers = {element: JobLogger('logs', element) for element in elements}
-        main(elements, args.api, args.config_dir)
+        assert os.path.exists(args.elements_dir), 'Path to elements is not at current working directory, supply the directory with --elements-dir'
+        elements = next(os.walk(args.elements_dir))[1]
+        results = main(elements, args.api, args.config_dir, args.max_workers)
     else:
-        main(args.task_name, args.api, args.config_dir)
+        results = main(args.task_name, args.api, args.config_dir, args.max_workers)
+    # Failures are reported as results rather than raised, so they are turned into the exit status here
+    if any(result['status'] == 'failed' for result in results):
+        sys.exit(1)
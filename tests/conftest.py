@@ -0,0 +1,6 @@
+# Built-in packages
+import os
+import sys
+
+# The tests import the utils package from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
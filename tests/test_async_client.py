@@ -0,0 +1,149 @@
+"""
+Tests of the asyncio API path against a fake completion server.
+
+The server is an httpx.MockTransport answering chat completions deterministically from the request's messages, so the
+sync and async clients can be compared without network access. The async handler sleeps for a random time so the
+requests of different base_ids interleave.
+"""
+
+# Built-in packages
+import asyncio
+import hashlib
+import itertools
+import json
+import random
+
+# External packages
+import httpx
+import openai
+import pytest
+
+# Local packages
+from utils.inference_utils import get_response, get_responses_async
+from utils.model_utils import GPTClient, AsyncGPTClient
+
+OPTIONS = ['first option', 'second option', 'third option', 'fourth option']
+NUM_BASE_IDS = 12
+NUM_SUB_QUESTIONS = 3
+LETTERS = 'ABCDEFGHIJKL'
+
+
+def completion_body(payload):
+    """
+    Builds a chat completion that only depends on the messages of the request.
+    """
+    digest = int(hashlib.md5(json.dumps(payload['messages']).encode('utf-8')).hexdigest(), 16)
+    if payload.get('logprobs'):
+        # Option letters run on across the sub-questions of a base_id, so every letter they can use is scored
+        top_logprobs = [{'token': letter, 'logprob': -((digest >> (4 * i)) % 7) - 0.1, 'bytes': None} for i, letter in enumerate(LETTERS)]
+        logprobs = {'content': [{'token': 'A', 'logprob': -0.1, 'bytes': None, 'top_logprobs': top_logprobs}]}
+        content = 'A'
+    else:
+        logprobs = None
+        content = f'Reasoning {digest % 1000}. Correct Answer: B'
+    return {
+        'id': 'fake',
+        'object': 'chat.completion',
+        'created': 0,
+        'model': payload['model'],
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}, 'logprobs': logprobs}],
+    }
+
+
+class FakeServer:
+    """
+    Records the messages of every request it answers, in the order they arrive.
+    """
+    def __init__(self):
+        self.requests = []
+
+    def handle(self, request):
+        payload = json.loads(request.content)
+        self.requests.append(payload['messages'])
+        return httpx.Response(200, json=completion_body(payload))
+
+    async def handle_async(self, request):
+        await asyncio.sleep(random.uniform(0, 0.01))
+        return self.handle(request)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    return FakeServer()
+
+
+def make_clients(server):
+    client = GPTClient(client='openai')
+    client.client = openai.OpenAI(api_key='test', base_url='http://fake/v1', http_client=httpx.Client(transport=httpx.MockTransport(server.handle)))
+    async_client = AsyncGPTClient(client='openai')
+    async_client.client = openai.AsyncOpenAI(api_key='test', base_url='http://fake/v1', http_client=httpx.AsyncClient(transport=httpx.MockTransport(server.handle_async)))
+    return client, async_client
+
+
+def make_base_ids(question_type):
+    """
+    Returns the prefixes, questions and options of NUM_BASE_IDS base_ids. sequential-* question types have an
+    explanation turn and an answer turn per sub-question.
+    """
+    turns_per_question = 2 if question_type.startswith('sequential') else 1
+    prefixes, questions_lst, options_lsts = [], [], []
+    for base_id in range(NUM_BASE_IDS):
+        prefixes.append(f'Base id {base_id}.')
+        questions_lst.append([f'Question {base_id}.{i // turns_per_question} turn {i % turns_per_question}' for i in range(NUM_SUB_QUESTIONS * turns_per_question)])
+        options_lsts.append([OPTIONS] * NUM_SUB_QUESTIONS)
+    return prefixes, questions_lst, options_lsts
+
+
+def run_async(async_client, prefixes, questions_lst, question_type, options_lsts):
+    async def run():
+        try:
+            return await get_responses_async(async_client, 'gpt-4', prefixes, questions_lst, question_type, options_lsts, 'list', max_concurrency=4)
+        finally:
+            await async_client.client.close()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('question_type', ['mc', 'explanation', 'sequential-hidden', 'sequential-shown'])
+def test_async_matches_sync(server, question_type):
+    client, async_client = make_clients(server)
+    prefixes, questions_lst, options_lsts = make_base_ids(question_type)
+
+    sync_responses = [get_response(client, 'gpt-4', prefix, questions, question_type, options_lst, 'list') for prefix, questions, options_lst in zip(prefixes, questions_lst, options_lsts)]
+    async_responses, inference_times = run_async(async_client, prefixes, questions_lst, question_type, options_lsts)
+
+    assert async_responses == sync_responses
+    assert len(inference_times) == NUM_BASE_IDS
+
+
+@pytest.mark.parametrize('question_type', ['sequential-hidden', 'sequential-shown'])
+def test_async_keeps_turn_order(server, question_type):
+    _, async_client = make_clients(server)
+    prefixes, questions_lst, options_lsts = make_base_ids(question_type)
+    run_async(async_client, prefixes, questions_lst, question_type, options_lsts)
+
+    # Group the requests by base_id, in the order the server received them
+    request_prefixes = [next(prefix for prefix in prefixes if messages[0]['content'].startswith(prefix)) for messages in server.requests]
+    requests_by_base_id = {prefix: [] for prefix in prefixes}
+    for prefix, messages in zip(request_prefixes, server.requests):
+        requests_by_base_id[prefix].append(messages)
+
+    # Requests of different base_ids interleave...
+    assert len(list(itertools.groupby(request_prefixes))) > NUM_BASE_IDS
+    # ...but each base_id's turns arrive one after the other, every turn carrying the model's answers to all previous
+    # turns of the same base_id
+    for prefix, questions in zip(prefixes, questions_lst):
+        requests = requests_by_base_id[prefix]
+        assert len(requests) == len(questions)
+        for turn, messages in enumerate(requests):
+            assert messages[-1]['content'].endswith(questions[turn])
+            answers = [message['content'] for message in messages if message['role'] == 'assistant']
+            assert len(answers) == turn
+            for previous_turn, answer in enumerate(answers):
+                if previous_turn % 2 == 0:
+                    # Explanation turns carry the completion text
+                    assert answer == completion_body({'model': 'gpt-4', 'messages': requests[previous_turn]})['choices'][0]['message']['content']
+                else:
+                    # Answer turns carry the most likely option letter of their sub-question
+                    sub_question = previous_turn // 2
+                    assert answer in LETTERS[sub_question * len(OPTIONS):(sub_question + 1) * len(OPTIONS)]
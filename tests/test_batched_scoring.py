@@ -0,0 +1,86 @@
+"""
+Tests that the batched and shared-prefix scorers match the per-question path on a tiny model.
+
+The model is a randomly initialised two-layer Llama with a character-level tokenizer, built in memory so the tests
+need no downloaded weights. Its predictions are meaningless, but every scorer reads the same next-token distributions,
+so the option probabilities must agree up to floating-point error and pick the same answer.
+"""
+
+# Built-in packages
+import string
+
+# External packages
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, processors
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# Local packages
+from utils.response_utils import get_mc, get_mc_batch, get_mc_separate, LengthBucketScheduler
+
+DEVICE = 'cpu'
+LETTERS = list(string.ascii_uppercase)
+QUESTIONS = [
+    ('Which animal barks? A. cat B. dog C. cow\nAnswer:', 3),
+    ('Is the sky green? A. yes B. no\nAnswer:', 2),
+    ('Pick the largest number. A. 3 B. 12 C. 7 D. 40 E. 1\nAnswer:', 5),
+    ('Q: 2+2? A. 4 B. 5 C. 22 D. 0\nAnswer:', 4),
+    ('A short one. A. x B. y\nAnswer:', 2),
+]
+
+
+@pytest.fixture(scope='module')
+def tiny_model():
+    """
+    Builds a character-level tokenizer and a seeded random Llama model over its vocabulary.
+    """
+    special_tokens = ['<unk>', '<s>', '</s>']
+    vocab = {token: i for i, token in enumerate(special_tokens + sorted(set(string.printable + '▁')))}
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[], unk_token='<unk>'))
+    backend.pre_tokenizer = pre_tokenizers.Metaspace()
+    backend.decoder = decoders.Metaspace()
+    backend.post_processor = processors.TemplateProcessing(single='<s> $A', special_tokens=[('<s>', vocab['<s>'])])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token='<s>', eos_token='</s>', unk_token='<unk>')
+
+    torch.manual_seed(0)
+    # A wide initialisation keeps the next-token distributions far from uniform, so the argmax is not a near tie
+    config = LlamaConfig(vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, initializer_range=0.5,
+                         bos_token_id=vocab['<s>'], eos_token_id=vocab['</s>'])
+    model = LlamaForCausalLM(config).eval()
+    return model, tokenizer
+
+
+def assert_same_response(response, expected):
+    answer, probs = response
+    expected_answer, expected_probs = expected
+    assert answer == expected_answer
+    assert list(probs) == list(expected_probs)
+    assert torch.allclose(torch.tensor(list(probs.values())), torch.tensor(list(expected_probs.values())), rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('max_tokens_per_batch', [None, 120])
+def test_get_mc_batch_matches_get_mc(tiny_model, max_tokens_per_batch):
+    model, tokenizer = tiny_model
+    texts = [text for text, _ in QUESTIONS]
+    options_lst = [LETTERS[:num_options] for _, num_options in QUESTIONS]
+    expected = [get_mc(model, tokenizer, text, options, DEVICE, None) for text, options in zip(texts, options_lst)]
+
+    # Without a budget every prompt is padded into one pass, with it the prompts are split into several buckets
+    scheduler = LengthBucketScheduler(max_tokens_per_batch) if max_tokens_per_batch else None
+    responses = get_mc_batch(model, tokenizer, texts, options_lst, DEVICE, None, scheduler=scheduler)
+
+    assert len(responses) == len(expected)
+    for response, expected_response in zip(responses, expected):
+        assert_same_response(response, expected_response)
+    if scheduler is not None:
+        assert scheduler.num_batches > 1
+
+
+def test_get_mc_separate_shared_prefix_matches_separate_passes(tiny_model):
+    model, tokenizer = tiny_model
+    for text, num_options in QUESTIONS:
+        options = LETTERS[:num_options]
+        expected = get_mc_separate(model, tokenizer, text, options, DEVICE, None, share_prefix=False)
+        response = get_mc_separate(model, tokenizer, text, options, DEVICE, None, share_prefix=True)
+        assert_same_response(response, expected)
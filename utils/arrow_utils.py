@@ -0,0 +1,151 @@
+# Built-in packages
+import json
+import os
+# External packages
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                              Arrow Element Format Code                            ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+# The four element files of a task, in the order returned by load_dfs
+ELEMENT_FILES = ['questions', 'questions_metadata', 'options', 'answers']
+# Low-cardinality string columns stored as dictionaries (pandas Categoricals once loaded)
+DICTIONARY_COLUMNS = ['question_id', 'domain', 'type', 'difficulty_level']
+ARROW_SUFFIX = '.arrow'
+# Schema metadata key listing the columns whose False values are stored as nulls
+FALSE_AS_NULL_KEY = b'false_as_null'
+# Strings are kept in Arrow memory once loaded instead of being copied into Python objects
+ARROW_STRING_TYPES = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+
+
+def get_arrow_paths(task_path):
+    return [os.path.join(task_path, name + ARROW_SUFFIX) for name in ELEMENT_FILES]
+
+
+def has_arrow_elements(task_path):
+    return all(os.path.exists(path) for path in get_arrow_paths(task_path))
+
+
+def encode_dictionary_columns(df, categories):
+    """
+    Returns a copy of df with the DICTIONARY_COLUMNS it has turned into Categoricals with the given categories.
+    """
+    df = df.copy()
+    for column in DICTIONARY_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.Categorical(df[column], categories=categories[column])
+    return df
+
+
+def get_false_as_null_columns(df):
+    """
+    Returns the object columns holding either a string or False, such as explanation.
+
+    Arrow cannot type a column mixing strings and booleans, so these are stored as strings with False as null.
+    """
+    is_false = lambda value: value is False
+    is_string_or_false = lambda value: value is False or isinstance(value, str)
+    return [column for column in df.columns if df[column].dtype == object and df[column].map(is_false).any() and df[column].map(is_string_or_false).all()]
+
+
+def convert_element_dir(task_path):
+    """
+    Writes the four element pickles of a task next to them as uncompressed Arrow IPC (Feather v2) files.
+
+    The files are left uncompressed so that they can be memory-mapped and read without copying the column buffers.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    paths = get_arrow_paths(task_path)
+    dfs = [pd.read_pickle(os.path.join(task_path, name + '.pkl')) for name in ELEMENT_FILES]
+
+    # Every file shares the same sorted dictionary of a column, so it is turned into a pandas dtype once per load.
+    # Sorted categories also make groupby visit the groups in the same order as on the pickled frames, so the seeded
+    # samples drawn from them are unchanged.
+    categories = {}
+    for column in DICTIONARY_COLUMNS:
+        values = set()
+        for df in dfs:
+            if column in df.columns:
+                values.update(df[column].dropna().unique())
+        categories[column] = sorted(values)
+
+    for df, path in zip(dfs, paths):
+        df = encode_dictionary_columns(df, categories)
+        false_as_null = get_false_as_null_columns(df)
+        for column in false_as_null:
+            df[column] = df[column].where(df[column].map(lambda value: value is not False), None)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), FALSE_AS_NULL_KEY: json.dumps(false_as_null).encode('utf-8')})
+        # Written to a temporary file first so a reader never sees a partial file
+        feather.write_feather(table, path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+    return paths
+
+
+def get_categorical_dtype(dictionary, dtypes):
+    """
+    Returns the CategoricalDtype of an Arrow dictionary, reusing the one in dtypes if it was built from an equal one.
+    """
+    for other_dictionary, dtype in dtypes:
+        if other_dictionary.equals(dictionary):
+            return dtype
+    dtype = pd.CategoricalDtype(pd.Index(dictionary.to_pandas(types_mapper=ARROW_STRING_TYPES.get)))
+    dtypes.append((dictionary, dtype))
+    return dtype
+
+
+def read_arrow_df(path, dtypes=None):
+    """
+    Memory-maps an Arrow IPC file and returns it as a DataFrame.
+
+    Numeric columns and dictionary indices are read straight from the mapped pages, and string columns stay
+    Arrow-backed (string[pyarrow]) instead of being copied into Python objects. Processes loading the same file share
+    one copy of it in the page cache.
+
+    Parameters:
+    - path: The Arrow file.
+    - dtypes: Optional list of (dictionary, CategoricalDtype) pairs already built, extended with new ones. Building the
+      categories of question_id is the only part of a load that grows with the number of questions, so it is done
+      once for the four files of a task.
+    """
+    dtypes = [] if dtypes is None else dtypes
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    false_as_null = json.loads((table.schema.metadata or {}).get(FALSE_AS_NULL_KEY, b'[]'))
+
+    columns = {}
+    for name, column in zip(table.column_names, table.columns):
+        column = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+        if pa.types.is_dictionary(column.type):
+            codes = column.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+            columns[name] = pd.Categorical.from_codes(codes, dtype=get_categorical_dtype(column.dictionary, dtypes))
+        else:
+            columns[name] = column.to_pandas(types_mapper=ARROW_STRING_TYPES.get)
+    df = pd.DataFrame(columns, copy=False)
+
+    for column in false_as_null:
+        # These are compared against False, so they go back to object columns
+        df[column] = df[column].astype(object).where(df[column].notna(), False)
+    return df
+
+
+def load_arrow_dfs(task_path):
+    """
+    Loads the questions, questions_metadata, options and answers frames of a task from its Arrow files.
+    """
+    dtypes = []
+    return tuple(read_arrow_df(path, dtypes) for path in get_arrow_paths(task_path))
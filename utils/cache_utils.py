@@ -0,0 +1,496 @@
+# Built-in packages
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+# External packages
+import numpy as np
+import torch
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                               Prefix KV Cache Code                                ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+
+class PrefixNode:
+    """
+    Node of the token trie behind PrefixCache.
+
+    children maps the next token id to its node, count is the number of stored sequences passing through the node,
+    entry is the key of one of them (any of their caches covers the node's prefix) and end is the key of the stored
+    sequence ending at the node, if any. Keys are compared by identity, so they are always the tuples held in entries.
+    """
+    __slots__ = ('children', 'count', 'entry', 'end')
+
+    def __init__(self):
+        self.children = {}
+        self.count = 0
+        self.entry = None
+        self.end = None
+
+
+class PrefixCache:
+    """
+    Bounded LRU cache of past_key_values keyed on the token ids they were computed from.
+
+    Keys and values of a causal model at position i only depend on the tokens up to i, so the cache of any stored
+    sequence is also a valid cache for every prefix of it. A lookup therefore finds the stored sequence sharing the
+    longest prefix with the new prompt and crops its cache to that length; the forward pass then only has to encode
+    the remaining tokens. This is what lets few-shot prefixes and the growing context of sequential-* questions be
+    encoded once instead of on every call.
+
+    Stored sequences are indexed in a token trie, so a lookup walks the prompt once whatever the number of entries.
+
+    Caches are held on the model's device in the legacy (key, value) per-layer tuple format. Entries are evicted
+    least-recently-used first once the total size of the stored tensors exceeds max_bytes.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = OrderedDict()  # tuple of token ids -> (legacy cache, cache class, size in bytes)
+        self.root = PrefixNode()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def lookup(self, sequence):
+        """
+        Finds the cached prefix of a sequence.
+
+        Parameters:
+        - sequence (list): The token ids of the prompt about to be run.
+
+        Returns:
+        - int, past_key_values: The number of leading tokens covered by the cache (always less than len(sequence) so
+          that at least one token is left to compute logits for) and the cropped cache, or 0 and None on a miss.
+        """
+        node, best_len = self.root, 0
+        for token_id in sequence[:len(sequence) - 1]:
+            child = node.children.get(token_id)
+            if child is None:
+                break
+            node, best_len = child, best_len + 1
+
+        if best_len == 0:
+            self.misses += 1
+            return 0, None
+
+        best_key = node.entry
+        self.entries.move_to_end(best_key)
+        legacy_cache, cache_class, _ = self.entries[best_key]
+        cropped = tuple(tuple(tensor[:, :, :best_len] for tensor in layer) for layer in legacy_cache)
+        self.hits += 1
+        self.reused_tokens += best_len
+        if cache_class is not None:
+            return best_len, cache_class.from_legacy_cache(cropped)
+        return best_len, cropped
+
+    def insert(self, sequence, past_key_values):
+        """
+        Stores the cache of a sequence, dropping stored sequences it extends and evicting old entries if over budget.
+
+        Caches that are not laid out as (batch, heads, sequence, head_dim) tensors with one position per token are not
+        stored, since they cannot be cropped safely.
+        """
+        cache_class = type(past_key_values) if hasattr(past_key_values, 'to_legacy_cache') else None
+        legacy_cache = past_key_values.to_legacy_cache() if cache_class is not None else past_key_values
+        try:
+            tensors = [tensor for layer in legacy_cache for tensor in layer]
+        except TypeError:
+            return
+        if not tensors or not all(isinstance(tensor, torch.Tensor) and tensor.dim() == 4 and tensor.shape[0] == 1 and tensor.shape[-2] == len(sequence) for tensor in tensors):
+            return
+
+        size = sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+        if size > self.max_bytes:
+            return
+
+        key = tuple(sequence)
+        # A stored prefix of this sequence (or the sequence itself) is subsumed by the new entry
+        node, subsumed = self.root, []
+        for token_id in key:
+            node = node.children.get(token_id)
+            if node is None:
+                break
+            if node.end is not None:
+                subsumed.append(node.end)
+        for other in subsumed:
+            self.remove(other)
+
+        self.entries[key] = (legacy_cache, cache_class, size)
+        self.num_bytes += size
+        node = self.root
+        for token_id in key:
+            node = node.children.setdefault(token_id, PrefixNode())
+            node.count += 1
+            node.entry = key
+        node.end = key
+        while self.num_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """
+        Drops a stored sequence and prunes the trie nodes no other entry passes through.
+        """
+        path, node = [], self.root
+        for token_id in key:
+            path.append((node, token_id))
+            node = node.children[token_id]
+        key, node.end = node.end, None
+        self.num_bytes -= self.entries.pop(key)[2]
+        # Walk back up so that the children of a node are fixed before the node itself
+        for parent, token_id in reversed(path):
+            child = parent.children[token_id]
+            child.count -= 1
+            if child.count == 0:
+                del parent.children[token_id]
+            elif child.entry is key:
+                child.entry = child.end if child.end is not None else next(iter(child.children.values())).entry
+
+    def clear(self):
+        self.entries.clear()
+        self.root = PrefixNode()
+        self.num_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'reused_tokens': self.reused_tokens, 'entries': len(self.entries), 'bytes': self.num_bytes}
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                              API Response Cache Code                              ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+
+class CacheMissError(KeyError):
+    """
+    Raised in replay mode when a request is not in the cache.
+    """
+
+
+def hash_request(params):
+    """
+    Content hash of the parameters of a chat completion request (model, messages, max_tokens, logprobs,
+    top_logprobs, seed, and the remaining sampling parameters).
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of API responses stored in SQLite.
+
+    Responses are stored as JSON under the hash of the request that produced them. With temperature 0 and a fixed
+    seed the responses are meant to be reproducible, so a re-run of a configuration is served from disk instead of
+    paying for the same calls again. The least recently used responses are evicted once the stored responses exceed
+    max_bytes.
+
+    In read-only mode the database is opened read-only, nothing is written or evicted, and a request missing from the
+    cache raises CacheMissError, so a whole evaluation can be replayed offline.
+
+    The cache can be shared by threads and, through SQLite's own locking, by processes. The total size of the stored
+    responses is read once when the cache is opened and kept up to date by put, so it does not see responses written
+    by other processes until the cache is reopened.
+    """
+    def __init__(self, path, max_bytes=None, read_only=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if read_only:
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False, timeout=30)
+        else:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+            self.connection.commit()
+        self.total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        """
+        Returns the stored JSON response of a request hash, or None if it is not cached (CacheMissError in read-only mode).
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.read_only:
+                    raise CacheMissError(f'Request {key} is not in the response cache {self.path}')
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+                self.connection.commit()
+            return row[0]
+
+    def put(self, key, value):
+        """
+        Stores the JSON response of a request hash and evicts the least recently used responses if over max_bytes.
+        """
+        if self.read_only:
+            return
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            replaced = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+            self.total_size += size - (replaced[0] if replaced is not None else 0)
+            if self.max_bytes is not None and self.total_size > self.max_bytes:
+                self.evict(key, self.total_size - self.max_bytes)
+            self.connection.commit()
+
+    def evict(self, key, num_bytes):
+        """
+        Deletes the least recently used responses, other than key, that together free at least num_bytes.
+        """
+        # Running sum of the sizes in eviction order, so the rows to delete are counted in a single query
+        num_rows, freed = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ('
+            'SELECT size, SUM(size) OVER (ORDER BY last_access, key ROWS UNBOUNDED PRECEDING) AS cumulative_size '
+            'FROM responses WHERE key != ?) WHERE cumulative_size - size < ?', (key, num_bytes)).fetchone()
+        if num_rows:
+            self.connection.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses WHERE key != ? ORDER BY last_access, key LIMIT ?)', (key, num_rows))
+            self.total_size -= freed
+
+    def close(self):
+        self.connection.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                                Logits Cache Code                                  ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+
+class LogitsCache:
+    """
+    Persistent cache of next-token probabilities of a local model, stored in SQLite.
+
+    Only the probabilities of the tokens that were asked for (the option tokens) are kept, not the full-vocabulary
+    logits. Entries are keyed by a hash of the model key (snapshot hash and dtype) and the prompt's token ids, so an mc
+    or mc-separate prompt is scored once across reruns and across the configurations that share the cache file.
+    Probabilities of new tokens for an already cached prompt are merged into its entry.
+    """
+    def __init__(self, path, model_key):
+        self.path = path
+        self.model_key = model_key
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS token_probs (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.commit()
+
+    def hash_sequence(self, sequence):
+        return hashlib.sha256(self.model_key.encode('utf-8') + b'\0' + np.asarray(sequence, dtype=np.int64).tobytes()).hexdigest()
+
+    def get(self, sequence, token_ids):
+        """
+        Returns the cached next-token probabilities of token_ids after sequence, or None unless all of them are cached.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM token_probs WHERE key = ?', (self.hash_sequence(sequence),)).fetchone()
+            token_probs = json.loads(row[0]) if row is not None else {}
+            if not all(str(token_id) in token_probs for token_id in token_ids):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [token_probs[str(token_id)] for token_id in token_ids]
+
+    def put(self, sequence, token_ids, probs):
+        """
+        Stores the next-token probabilities of token_ids after sequence, merging them with those already cached.
+        """
+        key = self.hash_sequence(sequence)
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM token_probs WHERE key = ?', (key,)).fetchone()
+            token_probs = json.loads(row[0]) if row is not None else {}
+            token_probs.update({str(token_id): prob for token_id, prob in zip(token_ids, probs)})
+            self.connection.execute('INSERT OR REPLACE INTO token_probs (key, value) VALUES (?, ?)', (key, json.dumps(token_probs)))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                                Token Store Code                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+# Text whose encoding is part of a tokenizer's fingerprint, to catch differences in normalization and special tokens
+FINGERPRINT_PROBE = 'Question 1: Which option is correct?\nA. yes\nB. no\n\nCorrect Answer: '
+# Record layout of an index segment: prompt hash as hex, offset into the token segment, number of tokens. The hash is
+# stored as text because numpy 'S' fields drop trailing NUL bytes, which would change the key of some digests
+INDEX_DTYPE = np.dtype([('key', 'U32'), ('offset', '<i8'), ('length', '<i8')])
+
+
+def tokenizer_fingerprint(tokenizer, chat_type):
+    """
+    Hash identifying how a tokenizer turns prompts into token ids: its class, vocabulary, chat template, the encoding
+    of a probe text, and the chat_type the prompts are built for. Models of one family that share a tokenizer get the
+    same fingerprint.
+    """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(type(tokenizer).__name__.encode('utf-8'))
+    fingerprint.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode('utf-8'))
+    fingerprint.update(json.dumps(getattr(tokenizer, 'chat_template', None)).encode('utf-8'))
+    fingerprint.update(json.dumps(tokenizer.encode(FINGERPRINT_PROBE)).encode('utf-8'))
+    fingerprint.update(str(chat_type).encode('utf-8'))
+    return fingerprint.hexdigest()[:32]
+
+
+def hash_prompt(text):
+    """
+    16-byte hash of a prompt, either a string or a list of chat messages, as 32 hex characters.
+    """
+    return hashlib.sha256(json.dumps(text, ensure_ascii=False).encode('utf-8')).hexdigest()[:32]
+
+
+class TokenStore:
+    """
+    Persistent store of the token ids of prompts, shared by the models whose tokenizers have the same fingerprint.
+
+    Token ids are packed as int32 in segment files under <path>/<fingerprint>/, each with an index of the prompt
+    hashes, offsets and lengths it holds. Existing segments are memory-mapped when the store is opened, so a lookup
+    reads a slice of the page cache instead of running the tokenizer. New prompts are appended to a new segment on
+    flush; the index is renamed into place last, so a segment is either complete or ignored. Several processes can add
+    to the same store, e.g. when a task is pre-tokenized in parallel.
+    """
+    def __init__(self, path, fingerprint, flush_every=100000):
+        self.directory = os.path.join(path, fingerprint)
+        self.flush_every = flush_every
+        os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+        # prompt hash -> (segment, offset, length)
+        self.index = {}
+        self.segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('index-') and name.endswith('.npy'):
+                self.load_segment(name[len('index-'):-len('.npy')])
+
+        self.pending = {}
+        self.num_pending_tokens = 0
+
+    def load_segment(self, segment_id):
+        tokens_path = os.path.join(self.directory, f'tokens-{segment_id}.bin')
+        records = np.load(os.path.join(self.directory, f'index-{segment_id}.npy'))
+        # Segments written with another index layout cannot be matched against the current keys
+        if records.dtype != INDEX_DTYPE or not len(records):
+            return
+        self.segments.append(np.memmap(tokens_path, dtype=np.int32, mode='r'))
+        segment = len(self.segments) - 1
+        for key, offset, length in records.tolist():
+            self.index[key] = (segment, offset, length)
+
+    def get(self, text):
+        """
+        Returns the token ids of a prompt, or None if it has not been stored.
+        """
+        key = hash_prompt(text)
+        if key in self.pending:
+            self.hits += 1
+            return list(self.pending[key])
+        location = self.index.get(key)
+        if location is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        segment, offset, length = location
+        return self.segments[segment][offset:offset + length].tolist()
+
+    def put(self, text, sequence):
+        key = hash_prompt(text)
+        if key in self.index or key in self.pending:
+            return
+        self.pending[key] = sequence
+        self.num_pending_tokens += len(sequence)
+        if self.num_pending_tokens >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending prompts to a new segment and maps it.
+        """
+        if not self.pending:
+            return
+        segment_id = f'{time.time_ns():020d}-{os.getpid()}'
+        tokens_path = os.path.join(self.directory, f'tokens-{segment_id}.bin')
+        index_path = os.path.join(self.directory, f'index-{segment_id}.npy')
+
+        records = np.zeros(len(self.pending), dtype=INDEX_DTYPE)
+        lengths = np.array([len(sequence) for sequence in self.pending.values()], dtype=np.int64)
+        records['key'] = list(self.pending.keys())
+        records['length'] = lengths
+        records['offset'] = np.cumsum(lengths) - lengths
+        tokens = np.fromiter((token_id for sequence in self.pending.values() for token_id in sequence), dtype=np.int32, count=int(lengths.sum()))
+
+        with open(tokens_path, 'wb') as f:
+            tokens.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(index_path + '.tmp', 'wb') as f:
+            np.save(f, records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_path + '.tmp', index_path)
+
+        self.pending = {}
+        self.num_pending_tokens = 0
+        self.load_segment(segment_id)
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'prompts': len(self.index) + len(self.pending)}
@@ -1,3 +1,8 @@
+# Built-in packages
+import os
+import pickle
+import time
+# External packages
 import pandas as pd
 
 def create_base_results_df():
@@ -26,51 +31,200 @@ def create_base_metadata_df():
     ])
     return metadata_df
 
-def load_results(file_path):
+class ResultBuffer:
+    """
+    Growable columnar buffer of result records.
+
+    Records are appended column by column to per-column lists, so adding a question costs the same no matter how many
+    results are already held. The buffer is turned into a DataFrame once, when it is checkpointed or the run finishes,
+    instead of concatenating a growing DataFrame for every question.
+    """
+    def __init__(self):
+        self.columns = {}
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
+
+    def append(self, record):
+        # A column first seen in this record is back-filled for the earlier rows
+        for key in record:
+            if key not in self.columns:
+                self.columns[key] = [None] * self.num_rows
+        for key, values in self.columns.items():
+            values.append(record.get(key))
+        self.num_rows += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.columns, index=pd.RangeIndex(self.num_rows))
+
+    def clear(self):
+        self.columns = {}
+        self.num_rows = 0
+
+
+def load_results(file_path, segment_dir=None):
     """
     Load dataset from a file.
     If the file does not exist, return a blank pandas dataframe.
+    If segment_dir is given, results of checkpoint segments written there are appended.
     """
     try:
-        return pd.read_pickle(file_path)
+        results_df = pd.read_pickle(file_path)
     except FileNotFoundError:
-        return create_base_results_df()
+        results_df = create_base_results_df()
+    return merge_segments(results_df, segment_dir, 'results')
 
-def load_metadata(file_path):
+def load_metadata(file_path, segment_dir=None):
     """
     Load metadata from a file.
     If the file does not exist, return a blank pandas dataframe.
+    If segment_dir is given, metadata of checkpoint segments written there are appended.
     """
     try:
-        return pd.read_pickle(file_path)
+        metadata_df = pd.read_pickle(file_path)
     except FileNotFoundError:
-        return create_base_metadata_df()
+        metadata_df = create_base_metadata_df()
+    return merge_segments(metadata_df, segment_dir, 'metadata')
 
 def save_dataset(dataset, file_path):
     """
     Save dataset to a file.
+    The file is written next to its destination and moved into place, so an interrupted save never leaves a partial file.
     """
-    dataset.to_pickle(file_path)
+    tmp_path = file_path + '.tmp'
+    dataset.to_pickle(tmp_path)
+    os.replace(tmp_path, file_path)
+
+
+#########################################################################################
+##                                                                                     ##
+##                                                                                     ##
+##                                                                                     ##
+##                               Checkpoint Code                                       ##
+##                                                                                     ##
+##                                                                                     ##
+##                                                                                     ##
+#########################################################################################
 
 
-def check_num_rows(dataset, args):
+def list_segments(segment_dir):
     """
-    Check if the number of saved input rows for each type, domain, and difficulty_level
-    are the same as in args['num_sample'].
+    Return the paths of all complete checkpoint segments in segment_dir, oldest first.
     """
-    if len(dataset) == 0:
-        return False
-    num_sample = args['num_sample']
-    num_rows = dataset.groupby(['domain', 'difficulty_level', 'type', 'num_shots', 'allow_explanation']).size()
+    if segment_dir is None or not os.path.isdir(segment_dir):
+        return []
+    return [os.path.join(segment_dir, name) for name in sorted(os.listdir(segment_dir)) if name.startswith('segment-') and name.endswith('.pkl')]
 
-    return all(num_rows == num_sample)
+def merge_segments(dataset, segment_dir, key):
+    """
+    Append the `key` frame ('results' or 'metadata') of every checkpoint segment in segment_dir to dataset.
+    Segments that were already consolidated into dataset (see consolidate_segments) are skipped.
+    """
+    consolidated = set(dataset.attrs.get('consolidated_segments', []))
+    frames = []
+    for segment_path in list_segments(segment_dir):
+        if os.path.basename(segment_path) in consolidated:
+            continue
+        with open(segment_path, 'rb') as f:
+            frames.append(pickle.load(f)[key])
+    if not frames:
+        return dataset
+    return pd.concat([dataset] + frames, sort=False, ignore_index=True)
 
+def consolidate_segments(results_df, metadata_df, results_path, metadata_path, segment_dir):
+    """
+    Save the full results and metadata, which already include every segment in segment_dir, and delete the segments.
 
-def get_uncompleted_dfs(datasets, question_ids):
+    The names of the consolidated segments are stored in the attrs of the saved frames, so if the process dies after
+    saving but before the segments are deleted they are not merged in a second time.
     """
-    Return the datasets with all uncompleted rows based on question_ids.
+    segment_paths = list_segments(segment_dir)
+    segment_names = [os.path.basename(segment_path) for segment_path in segment_paths]
+    for dataset, file_path in [(results_df, results_path), (metadata_df, metadata_path)]:
+        dataset.attrs['consolidated_segments'] = segment_names
+        save_dataset(dataset, file_path)
+
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+    if os.path.isdir(segment_dir) and not os.listdir(segment_dir):
+        os.rmdir(segment_dir)
+
+
+class CheckpointWriter:
+    """
+    Append-only checkpoint of completed evaluation results.
+
+    Results and metadata records are held in memory and flushed to a new segment file every `flush_every` questions or
+    `flush_interval` seconds, whichever comes first. A question is one add() call, i.e. one base_id with the result
+    rows of all its sub-questions. Each segment holds the results and metadata of the same questions
+    and is written to a temporary file that is then renamed, so a crash leaves either a complete segment or none.
+    load_results and load_metadata merge the segments back in when given the same segment_dir.
+
+    If score is given, it is applied to the results frame of every segment before it is written.
     """
-    if not question_ids:
-        return datasets
-    return [dataset[~dataset['question_id'].isin(question_ids)] for dataset in datasets]
+    def __init__(self, segment_dir, flush_every=100, flush_interval=300, score=None):
+        self.segment_dir = segment_dir
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.score = score
+        os.makedirs(segment_dir, exist_ok=True)
+
+        self.num_segments = 0
+        self.results, self.metadata = ResultBuffer(), ResultBuffer()
+        self.num_pending = 0
+        self.last_flush = time.time()
+
+    def add(self, results, metadata):
+        """
+        Add the results and metadata records of a completed question and flush if a threshold is reached.
+        """
+        self.results.extend(results)
+        self.metadata.extend(metadata)
+        self.num_pending += 1
+        if self.num_pending >= self.flush_every or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
 
+    def flush(self):
+        """
+        Write the pending records to a new segment.
+        """
+        self.last_flush = time.time()
+        if not len(self.results) and not len(self.metadata):
+            return
+        results = self.results.to_frame()
+        segment = {
+            'results': self.score(results) if self.score is not None else results,
+            'metadata': self.metadata.to_frame(),
+        }
+
+        # Segment names sort in write order and are never reused across runs
+        segment_path = os.path.join(self.segment_dir, f'segment-{time.time_ns():020d}-{self.num_segments:06d}.pkl')
+        tmp_path = segment_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(segment, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, segment_path)
+
+        self.num_segments += 1
+        self.num_pending = 0
+        self.results.clear()
+        self.metadata.clear()
+
+
+def get_completed_base_ids(dataset, params):
+    """
+    Return the base_ids that already have results for the num_shots, allow_explanation and question_type in params.
+    """
+    if len(dataset) == 0:
+        return set()
+    completed = dataset
+    for key in ['num_shots', 'allow_explanation', 'question_type']:
+        if key in completed.columns:
+            completed = completed[completed[key] == params[key]]
+    return set(question_id.split('_')[0] for question_id in completed['question_id'])
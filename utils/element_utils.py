@@ -0,0 +1,293 @@
+# External packages
+import numpy as np
+import pandas as pd
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                               Element Store Code                                  ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+
+def get_base_id(question_id):
+    return question_id.split('_')[0]
+
+
+def get_record(df, positions, key):
+    """
+    Returns the first row of df at the positions of key as a dict of Python scalars, as to_dict('records') would, or
+    raises KeyError if df does not have key. Each column is read at that one position only.
+    """
+    key_positions = positions.get(key)
+    if key_positions is None or not len(key_positions):
+        raise KeyError(key)
+    record = {}
+    for column in df.columns:
+        value = df[column].iloc[key_positions[0]]
+        record[column] = value.item() if isinstance(value, np.generic) else value
+    return record
+
+
+def factorize_column(column):
+    """
+    Returns the integer code of every row of a key column and the unique keys the codes index. Categorical columns,
+    which is how Arrow elements load their ids, already carry both, so nothing is hashed or copied.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy(), pd.Index(column.cat.categories)
+    codes, uniques = pd.factorize(column, sort=False)
+    return codes, pd.Index(uniques)
+
+
+class PositionIndex:
+    """
+    The row positions of every key of a column, grouped from the column's integer codes.
+
+    Rows are ordered by code once with a stable argsort, so the positions of a key are a slice of that order, in the
+    original row order. No Python object is created per row; a key is resolved through the hash index of the unique
+    keys on first lookup.
+    """
+    def __init__(self, codes, keys):
+        self.keys = keys
+        self.order = np.argsort(codes, kind='stable')
+        self.starts = np.searchsorted(codes[self.order], np.arange(len(keys) + 1))
+
+    @classmethod
+    def from_column(cls, column):
+        return cls(*factorize_column(column))
+
+    def get(self, key):
+        """
+        Returns the row positions of key, or None if the column does not have it.
+        """
+        try:
+            code = self.keys.get_loc(key)
+        except KeyError:
+            return None
+        return self.order[self.starts[code]:self.starts[code + 1]]
+
+
+class ElementStore:
+    """
+    Index over the four element DataFrames returned by load_dfs.
+
+    Every question_id is mapped to its row positions in the frames, and sub-questions are grouped by base_id, through
+    PositionIndex built from the codes of the id columns. Rows are only read from the frames when they are asked for,
+    so building the store does not copy the (possibly memory-mapped) columns onto the Python heap, and every lookup used
+    to build prompts and prefixes is a hash lookup instead of a scan over the whole DataFrame.
+
+    The original DataFrames are kept as attributes for code that still samples or merges over them.
+    """
+    def __init__(self, questions_df, questions_metadata, options_df, answers_df):
+        self.questions_df = questions_df
+        self.questions_metadata = questions_metadata
+        self.options_df = options_df
+        self.answers_df = answers_df
+
+        # question_id -> row position in questions_df and questions_metadata
+        self.question_codes, self.question_ids = factorize_column(questions_df['question_id'])
+        self.question_positions = PositionIndex(self.question_codes, self.question_ids)
+        self.metadata_positions = PositionIndex.from_column(questions_metadata['question_id'])
+        # question_id -> row as a dict, filled on first use
+        self.questions = {}
+        self.metadata = {}
+
+        # base_id -> positions of its sub-questions in questions_df, in their order. Base ids are cut from the unique
+        # question_ids and mapped back to the rows through the codes
+        base_ids = pd.Series(self.question_ids, dtype='string[pyarrow]').str.replace(r'_.*$', '', regex=True)
+        base_codes, base_ids = pd.factorize(base_ids, sort=False)
+        self.sub_question_positions = PositionIndex(base_codes[self.question_codes], pd.Index(base_ids))
+
+        # question_id -> row positions in options_df and answers_df
+        self.option_positions = PositionIndex.from_column(options_df['question_id'])
+        self.answer_positions = PositionIndex.from_column(answers_df['question_id'])
+        self.correct_answers = answers_df['correct_answer'].to_numpy()
+        self.answer_table = None
+        # question_id -> (option_ids, option_texts), filled on first use
+        self.option_lists = {}
+
+    def get_sub_question_ids(self, base_id):
+        """
+        Returns the question_ids of all sub-questions of a base_id.
+        """
+        positions = self.sub_question_positions.get(base_id)
+        if positions is None:
+            return []
+        return self.question_ids[self.question_codes[positions]].tolist()
+
+    def get_question(self, question_id):
+        if question_id not in self.questions:
+            self.questions[question_id] = get_record(self.questions_df, self.question_positions, question_id)
+        return self.questions[question_id]
+
+    def get_metadata(self, question_id):
+        if question_id not in self.metadata:
+            self.metadata[question_id] = get_record(self.questions_metadata, self.metadata_positions, question_id)
+        return self.metadata[question_id]
+
+    def get_options(self, question_id):
+        """
+        Returns the rows of options_df belonging to a question_id, in their original order.
+        """
+        positions = self.option_positions.get(question_id)
+        if positions is None:
+            return self.options_df.iloc[0:0]
+        return self.options_df.iloc[positions]
+
+    def get_option_lists(self, question_id):
+        """
+        Returns the option_ids and option texts of a question_id as lists, in the original order of options_df.
+        """
+        if question_id not in self.option_lists:
+            options = self.get_options(question_id)
+            self.option_lists[question_id] = (options['option_id'].tolist(), options['option_text'].tolist())
+        return self.option_lists[question_id]
+
+    def get_answers(self, question_id):
+        """
+        Returns the n-hot correct_answer labels of a question_id, in the original order of answers_df.
+        """
+        positions = self.answer_positions.get(question_id)
+        if positions is None:
+            return []
+        return self.correct_answers[positions].tolist()
+
+    def get_answer_table(self):
+        """
+        Returns the correct_answer labels of every question as a padded matrix, for scoring many results at once.
+
+        Returns:
+        - pd.Index: The question_ids, in the order of the rows.
+        - np.ndarray: (num_questions, max_options) labels in the original order of answers_df, padded with 0.
+        - np.ndarray: (num_questions, max_options) boolean mask of the real options.
+        """
+        if self.answer_table is None:
+            codes, question_ids = pd.factorize(self.answers_df['question_id'], sort=False)
+            # Position of each option within its question, in the order of answers_df
+            option_positions = pd.Series(codes).groupby(codes, sort=False).cumcount().to_numpy()
+            num_options = np.bincount(codes, minlength=len(question_ids))
+            shape = (len(question_ids), num_options.max() if len(num_options) else 0)
+            labels = np.zeros(shape, dtype=self.correct_answers.dtype)
+            labels[codes, option_positions] = self.correct_answers
+            mask = np.zeros(shape, dtype=bool)
+            mask[codes, option_positions] = True
+            self.answer_table = (pd.Index(np.asarray(question_ids, dtype=object)), labels, mask)
+        return self.answer_table
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                               Stratified Sampling Code                            ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+# Columns whose value combinations (cells) are sampled evenly
+STRATA_COLUMNS = ['type', 'domain', 'difficulty_level']
+
+
+class StratificationIndex:
+    """
+    The test question_ids of every (type, domain, difficulty_level) cell of a task, built once.
+
+    A sample draws the same number of questions from every cell. Draws are made exactly as
+    test_metadata.groupby(STRATA_COLUMNS).sample(n=num_sample, random_state=random_state) does: one RandomState
+    shared by the cells, visited in groupby order. The samples are therefore unchanged from earlier results and
+    checkpoints. Each sample is cached, so every grid point and model of a task reuses it instead of querying and
+    regrouping the frames again.
+    """
+    def __init__(self, questions_df, questions_metadata):
+        # Exemplars (questions with an explanation) are kept out of the test questions
+        test_metadata = questions_metadata.iloc[questions_df.query("explanation == False").index]
+        grouped = test_metadata.groupby(STRATA_COLUMNS, observed=True)
+        question_ids = test_metadata['question_id'].to_numpy(dtype=object)
+        # cell -> question_ids, in the order groupby visits the cells
+        self.cells = {cell: question_ids[grouped.indices[cell]] for cell, _ in grouped}
+        self.samples = {}
+
+    def sample(self, num_sample, random_state=42):
+        """
+        Returns the frozensets of question_ids and of base_ids sampled from every cell with an integer seed.
+        """
+        key = (num_sample, random_state)
+        if key not in self.samples:
+            random_state = np.random.RandomState(random_state)
+            sampled = [question_ids[random_state.choice(len(question_ids), size=num_sample, replace=False)] for question_ids in self.cells.values()]
+            question_ids = frozenset(np.concatenate(sampled)) if sampled else frozenset()
+            self.samples[key] = (question_ids, frozenset(get_base_id(question_id) for question_id in question_ids))
+        return self.samples[key]
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                             Evaluation Context Code                               ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+
+class EvaluationContext:
+    """
+    Everything one task is evaluated against: its configuration and the ElementStore of its element files.
+
+    A context is created per task by run_evaluation, or by the caller and passed to it, and handed explicitly to
+    eval_models, create_results_dict and the scoring helpers. Nothing is stored at module level, so several tasks can
+    be evaluated in one process, side by side or one after another with the same loaded model, without scoring against
+    each other's answers. The per-task caches (the stratified samples, and the rendered prompts and few-shot prefixes
+    set by get_prompt_caches) live on the context, so a context kept across models shares them.
+    """
+    def __init__(self, args, element_store, stratification_index=None):
+        self.args = args
+        self.element_store = element_store
+        self.stratification_index = stratification_index
+        self.prompt_cache = None
+        self.exemplar_pool = None
+
+    def get_stratification_index(self):
+        if self.stratification_index is None:
+            self.stratification_index = StratificationIndex(self.questions_df, self.questions_metadata)
+        return self.stratification_index
+
+    def sample(self, num_sample):
+        """
+        Returns the question_ids and base_ids of the stratified sample of num_sample questions per cell, drawn once per
+        task and shared by every grid point and model.
+        """
+        return self.get_stratification_index().sample(num_sample)
+
+    @property
+    def task_name(self):
+        return self.args['task_name']
+
+    @property
+    def questions_df(self):
+        return self.element_store.questions_df
+
+    @property
+    def questions_metadata(self):
+        return self.element_store.questions_metadata
+
+    @property
+    def options_df(self):
+        return self.element_store.options_df
+
+    @property
+    def answers_df(self):
+        return self.element_store.answers_df
@@ -1,7 +1,9 @@
 #Built-in packages
+import asyncio
 import time
 import random
-from collections import defaultdict
+from collections import defaultdict, Counter
+from functools import partial
 import os
 from tqdm import tqdm
 from string import ascii_lowercase, ascii_uppercase
@@ -12,20 +14,24 @@ import torch
 import openai
 import backoff  # for exponential backoff
 # Local packages
-from utils.response_utils import HF_RESPONSE, get_explanation_probs, parse_response, compute_ece, get_correct, get_true_labels, get_random_acc
-from utils.question_utils import reconstruct_context, build_prefix, get_test_questions, permute_answer, convert_probabilities, append_question
+from utils.response_utils import HF_RESPONSE, HF_BATCH_RESPONSE, LengthBucketScheduler, get_option_token_table, get_explanation_probs, parse_response, score_results, encode_prompt, get_option_prompts
+from utils.question_utils import ExemplarPool, PromptCache, reconstruct_context, build_prefix, get_test_questions, get_question_random_state, permute_answer, convert_probabilities, append_question
 from utils.parsing_utils import find_answer_letter
 from utils.utils import get_option_letters, print_chat, read_as_defaultdict, load_dfs, get_chat_type, ParameterGrid
-from utils.model_utils import GPTClient, MODEL_PATH, load_model_tokenizer
+from utils.model_utils import GPTClient, AsyncGPTClient, MODEL_PATH, get_snapshot_path, load_model_tokenizer
 from utils.logger_utils import JobLogger
-from utils.dataset_utils import load_results, load_metadata, check_num_rows, get_uncompleted_dfs
+from utils.dataset_utils import load_results, load_metadata, get_completed_base_ids, consolidate_segments, CheckpointWriter, ResultBuffer
+from utils.cache_utils import PrefixCache, ResponseCache, LogitsCache, TokenStore, tokenizer_fingerprint
+from utils.element_utils import ElementStore, EvaluationContext
+from utils.rate_limit_utils import get_rate_limiter
 import torch
 
-QUESTIONS_DF, QUESTIONS_METADATA, OPTIONS_DF, ANSWERS_DF = None, None, None, None
-
 OPTIONS = list(ascii_uppercase)
 LETTERS = list(ascii_lowercase)
 
+# Columns whose result counts are logged while API models run
+COUNT_COLUMNS = ['domain', 'difficulty_level', 'type', 'num_shots', 'allow_explanation']
+
 ###########################################
 ##                                       ##
 ##             Helper Code               ##
@@ -54,8 +60,14 @@ def exponential_backoff_decorator(max_retries, base_delay):
 
     return decorator
 
-@backoff.on_exception(backoff.expo, openai.RateLimitError)
-def get_response(client, model, prefix, questions, question_type, options_lst, chat_type):
+def iterate_turns(prefix, questions, question_type, options_lst, chat_type):
+    """
+    Walks through the turns of one base_id for an API model, shared by get_response and get_response_async.
+
+    The generator yields a (method, kwargs) pair for every call to make on the client (get_answer or get_explanation)
+    and is sent back the result, so the sync and async drivers only differ in how they make the call. Its return value
+    is the parsed [model_explanations, model_answers, probabilities] of the base_id.
+    """
     outputs =  []
     parsed_results = []
 
@@ -69,32 +81,87 @@ def get_response(client, model, prefix, questions, question_type, options_lst, c
 
         # NOTE: until we get access to tokenizer can't to mc-separte
         if question_type == 'mc':
-            answer, probs = client.get_answer(valid_tokens = get_option_letters(options_lst)[i], model=model, messages = context, max_tokens = 1, logprobs = True, top_logprobs=len(options_lst[i])*2)
+            answer, probs = yield 'get_answer', dict(valid_tokens = get_option_letters(options_lst)[i], messages = context, max_tokens = 1, logprobs = True, top_logprobs=len(options_lst[i])*2)
             outputs.append(answer)
             parsed_results.append(['', answer, probs])
         
         # Model is allowed to explain and answer
         elif question_type == 'explanation':
-            output = client.get_explanation(model = model, messages = context, max_tokens = None)
+            output = yield 'get_explanation', dict(messages = context, max_tokens = None)
             explanation, answer = parse_response(output, options_lst, i)
             outputs.append(output)
-            parsed_results.append([explanation, answer, defaultdict(lambda: 0)])
+            parsed_results.append([explanation, answer, defaultdict(int)])
             # TODO: parse output
 
         # Model is allowed to explain only
         elif i % 2 == 0 and (question_type == 'sequential-hidden' or question_type == 'sequential-shown'):
-            output = client.get_explanation(model = model, messages = context, max_tokens = None)
+            output = yield 'get_explanation', dict(messages = context, max_tokens = None)
             outputs.append(output)
 
         # Model is allowed to answer only
         elif i % 2 == 1 and (question_type == 'sequential-hidden' or question_type == 'sequential-shown'):
-            answer, probs = client.get_answer(valid_tokens = get_option_letters(options_lst)[i//2], model=model, messages = context, max_tokens = 1, logprobs = True, top_logprobs=len(options_lst[i//2])*2)
+            answer, probs = yield 'get_answer', dict(valid_tokens = get_option_letters(options_lst)[i//2], messages = context, max_tokens = 1, logprobs = True, top_logprobs=len(options_lst[i//2])*2)
             outputs.append(answer)
             parsed_results.append([outputs[i-1], answer, probs])
     
     return np.array(parsed_results).T.tolist()
 
-def get_response_hf(model, tokenizer, device, prefix, questions, question_type, options_lst, chat_type):
+@backoff.on_exception(backoff.expo, openai.RateLimitError)
+def get_response(client, model, prefix, questions, question_type, options_lst, chat_type):
+    turns = iterate_turns(prefix, questions, question_type, options_lst, chat_type)
+    try:
+        method, kwargs = next(turns)
+        while True:
+            method, kwargs = turns.send(getattr(client, method)(model=model, **kwargs))
+    except StopIteration as stop:
+        return stop.value
+
+@backoff.on_exception(backoff.expo, openai.RateLimitError)
+async def get_response_async(client, model, prefix, questions, question_type, options_lst, chat_type):
+    """
+    Asyncio counterpart of get_response for an AsyncGPTClient. The turns of one base_id are still sent one after
+    the other, since every turn includes the answers to the previous ones.
+    """
+    turns = iterate_turns(prefix, questions, question_type, options_lst, chat_type)
+    try:
+        method, kwargs = next(turns)
+        while True:
+            method, kwargs = turns.send(await getattr(client, method)(model=model, **kwargs))
+    except StopIteration as stop:
+        return stop.value
+
+async def get_responses_async(client, model, prefixes, questions_lst, question_type, options_lsts, chat_type, max_concurrency):
+    """
+    Runs get_response_async for many independent base_ids, keeping up to max_concurrency of them in flight.
+
+    Returns:
+        list, list: The response of every base_id (None if the request was rejected) and its inference time, in the
+                    order of the inputs.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(prefix, questions, options_lst):
+        async with semaphore:
+            start_time = time.time()
+            try:
+                response = await get_response_async(
+                    client=client,
+                    model=model,
+                    prefix=prefix,
+                    questions=questions,
+                    question_type=question_type,
+                    options_lst=options_lst,
+                    chat_type=chat_type
+                )
+            except openai.BadRequestError as e:
+                print(f"Error: {e}")
+                response = None
+            return response, time.time() - start_time
+
+    outputs = await asyncio.gather(*[run(prefix, questions, options_lst) for prefix, questions, options_lst in zip(prefixes, questions_lst, options_lsts)])
+    return [response for response, _ in outputs], [inference_time for _, inference_time in outputs]
+
+def get_response_hf(model, tokenizer, device, prefix, questions, question_type, options_lst, chat_type, prefix_cache=None, logits_cache=None, token_store=None):
     outputs = []
     parsed_results = []
 
@@ -105,7 +172,7 @@ def get_response_hf(model, tokenizer, device, prefix, questions, question_type,
         prompt = append_question(context, question, chat_type)
 
         if question_type == 'mc' or question_type == 'mc-separate':
-            answer, probs = HF_RESPONSE[question_type](model, tokenizer, prompt, options_lst[i], device, chat_type)
+            answer, probs = HF_RESPONSE[question_type](model, tokenizer, prompt, options_lst[i], device, chat_type, prefix_cache=prefix_cache, logits_cache=logits_cache, token_store=token_store)
             outputs.append(answer)
             parsed_results.append(['', answer, probs])
 
@@ -125,7 +192,7 @@ def get_response_hf(model, tokenizer, device, prefix, questions, question_type,
             outputs.append(output)
 
         elif i % 2 == 1 and (question_type == 'sequential-hidden' or question_type == 'sequential-shown'):
-            answer, probs = HF_RESPONSE['mc'](model, tokenizer, prompt, options_lst[i], device, chat_type)
+            answer, probs = HF_RESPONSE['mc'](model, tokenizer, prompt, options_lst[i], device, chat_type, prefix_cache=prefix_cache, logits_cache=logits_cache, token_store=token_store)
             outputs.append(answer)
             parsed_results.append([outputs[i-1], answer, probs])
         
@@ -133,6 +200,34 @@ def get_response_hf(model, tokenizer, device, prefix, questions, question_type,
         # TODO: add condition where the model is asked if the answer is correct or not
     return np.array(parsed_results, dtype=object).T.tolist()
 
+def get_response_hf_batch(model, tokenizer, device, prefixes, questions_lst, question_type, options_lsts, chat_type, logits_cache=None, token_store=None, scheduler=None):
+    """
+    Batched counterpart of get_response_hf for question types listed in HF_BATCH_RESPONSE.
+
+    Sub-questions of one base_id see the model's answers to the previous sub-questions, so prompts are batched turn
+    by turn: the i-th sub-question of every base_id in the batch is scored in one forward pass before moving on to
+    the (i+1)-th. Within a turn, a scheduler splits the prompts into forward passes of similar length.
+
+    Returns:
+        list: One [model_explanations, model_answers, probabilities] triple per base_id, as returned by get_response_hf.
+    """
+    outputs = [[] for _ in questions_lst]
+    parsed_results = [[] for _ in questions_lst]
+
+    for i in range(max(len(questions) for questions in questions_lst)):
+        active = [j for j, questions in enumerate(questions_lst) if i < len(questions)]
+        prompts = [
+            append_question(reconstruct_context(prefixes[j], questions_lst[j][:i], outputs[j], chat_type), questions_lst[j][i], chat_type)
+            for j in active
+        ]
+        responses = HF_BATCH_RESPONSE[question_type](model, tokenizer, prompts, [options_lsts[j][i] for j in active], device, chat_type, logits_cache=logits_cache, token_store=token_store, scheduler=scheduler)
+
+        for j, (answer, probs) in zip(active, responses):
+            outputs[j].append(answer)
+            parsed_results[j].append(['', answer, probs])
+
+    return [np.array(parsed_result, dtype=object).T.tolist() for parsed_result in parsed_results]
+
 
 #########################################################################################
 #########################################################################################
@@ -150,30 +245,120 @@ def get_response_hf(model, tokenizer, device, prefix, questions, question_type,
 
 
 
-def create_results_dict(params, task_name, model_name, base_id, sub_id, permuted_answer, model_answer, model_explanation, probabilities, permutations):
-    # Setup results_dict
-    results = params
-    results['task_name'] = task_name
+def get_param_grid(args):
+    """
+    Returns the grid of prompting setups every model of a task is evaluated on.
+    """
+    return ParameterGrid([
+        {
+            'num_shots': [
+                0,
+                # 1, 
+                # 2, 
+                # 5
+            ], 
+            'allow_explanation': [False], 
+            'question_type': [
+                'mc',
+                'mc-separate'
+            ], 
+            'num_sample': [args['num_sample']]
+        }, 
+        # {
+        #     'num_shots': [
+        #         0, 
+        #         1, 
+        #         2, 
+        #         5
+        #     ], 
+        #     'allow_explanation': [True], 
+        #     'question_type': [
+        #         'explanation',
+        #         'sequential-hidden', 
+        #         'sequential-shown'
+        #     ], 
+        #     'num_sample': [args['num_sample']]
+        # }
+        ])
+
+
+def create_results_dict(context, params, model_name, base_id, sub_id, permuted_answer, model_answer, model_explanation, probabilities, permutations):
+    # Setup results_dict; accuracy, normalized_accuracy and expected_calibration are added by score_results
+    results = dict(params)
+    results['task_name'] = context.task_name
     results['model'] = model_name
     results['question_id'] = f'{base_id}_{sub_id}'
     results['permuted_answer'] = permuted_answer
     results['model_answer'] = model_answer
     results['model_explanation'] = model_explanation
     results['probabilities'] = probabilities
-    results['accuracy'] = get_correct(results['question_id'], ANSWERS_DF, permuted_answer)
-    # TODO: when expanding to multiple part questions, need to update get_random_acc to take in task_name and questions_metadata
-    results['normalized_accuracy'] = results['accuracy'] - get_random_acc(results['question_id'], ANSWERS_DF)
-    
-    true_labels = get_true_labels(results['question_id'], ANSWERS_DF)
-    probabilities_list = convert_probabilities(probabilities, sub_id, permutations)
-    results['expected_calibration'] = compute_ece(np.array(probabilities_list), np.array(true_labels))
+    # Probabilities in the original order of the options, compared against the answers by score_results
+    results['option_probabilities'] = convert_probabilities(probabilities, sub_id, permutations)
     
     return results
 
 
-def eval_models(args, api, device=None):
-
-    model_names = list(args['models'].keys())
+def get_result_paths(args, model_name):
+    """
+    Returns the results, metadata and checkpoint paths of a model for a task.
+    """
+    results_path = os.path.join(args['output_path'], model_name + '.pkl')
+    metadata_path = os.path.join(args['output_path'], model_name + '_metadata.pkl')
+    # Completed questions are checkpointed here until the model is done
+    checkpoint_dir = os.path.join(args['output_path'], model_name + '_checkpoint')
+    return results_path, metadata_path, checkpoint_dir
+
+
+def is_model_evaluated(args, stratification_index, model_name, results_df=None):
+    """
+    Whether a model already has results, counting checkpointed ones, for every sampled base_id at every grid point
+    (num_shots, allow_explanation and question_type) of a task. Only the task's StratificationIndex is needed to draw
+    the samples. results_df is loaded from disk if not given.
+    """
+    if results_df is None:
+        results_path, _, checkpoint_dir = get_result_paths(args, model_name)
+        results_df = load_results(results_path, checkpoint_dir)
+    for params in get_param_grid(args):
+        _, sampled_base_ids = stratification_index.sample(params['num_sample'])
+        if not sampled_base_ids <= get_completed_base_ids(results_df, params):
+            return False
+    return True
+
+
+def get_prompt_caches(context):
+    """
+    Returns the PromptCache and ExemplarPool of a task, built on first use and kept on its context, so every model
+    evaluated against the same context shares the rendered questions and few-shot prefixes.
+    """
+    if context.exemplar_pool is None:
+        context.prompt_cache = PromptCache()
+        context.exemplar_pool = ExemplarPool(context.element_store, context.prompt_cache)
+    return context.prompt_cache, context.exemplar_pool
+
+
+def eval_models(context, api, device=None, models=None, model_names=None):
+    """
+    Evaluates every model of a task's configuration and saves the results per model.
+
+    Args:
+        context (EvaluationContext): The configuration and elements of the task.
+        api (bool): Whether the models are API models.
+        device (str): Device local models are run on; None for API models.
+        models (dict): Optional model_name -> (model, tokenizer) of local models already loaded by the caller, so one
+            loaded model can be shared by the tasks evaluated in a process. Models missing from it are loaded here.
+        model_names (list): Optional subset of the configuration's models to evaluate. Defaults to all of them.
+    """
+    args = context.args
+    element_store = context.element_store
+    # Rendered questions and few-shot exemplars grouped by cell, shared by every model of the task
+    prompt_cache, exemplar_pool = get_prompt_caches(context)
+    model_names = [model_name for model_name in args['models'] if model_names is None or model_name in model_names]
+    # API responses are cached on disk, or only replayed from it when response_cache_replay is set
+    response_cache = None
+    if api and args['response_cache']:
+        response_cache = ResponseCache(args['response_cache'], args['response_cache_bytes'], read_only=bool(args['response_cache_replay']))
+    # Pre-tokenized prompts of local models, one store per tokenizer fingerprint
+    token_stores = {}
     # save results per model
     for model_name in model_names:
         if api:
@@ -183,178 +368,309 @@ def eval_models(args, api, device=None):
             job_logger = None
             progress_bar = tqdm
         
-        results_path = os.path.join(args['output_path'], model_name + '.pkl')
-        metadata_path = os.path.join(args['output_path'], model_name + '_metadata.pkl')
+        results_path, metadata_path, checkpoint_dir = get_result_paths(args, model_name)
 
-        results_df = load_results(results_path)
-        if check_num_rows(results_df, args):
+        results_df = load_results(results_path, checkpoint_dir)
+        if is_model_evaluated(args, context.get_stratification_index(), model_name, results_df):
             print(f"Model {model_name} has already been evaluated.")
             continue
-        results_metadata = load_metadata(metadata_path)
+        results_metadata = load_metadata(metadata_path, checkpoint_dir)
+        # New results are buffered column-wise and turned into DataFrames once the model is done
+        results_buffer, metadata_buffer = ResultBuffer(), ResultBuffer()
+        group_counts = Counter(results_df[COUNT_COLUMNS].itertuples(index=False, name=None))
+        checkpoint_writer = CheckpointWriter(checkpoint_dir, args['checkpoint_every'] or 100, args['checkpoint_interval'] or 300, score=partial(score_results, element_store=element_store))
+        batch_size = args['models'][model_name].get('batch_size', 1)
+        # Number of API requests kept in flight across base_ids
+        max_concurrency = args['models'][model_name].get('max_concurrency', 1)
+        # Few-shot prefixes and sequential contexts are resumed from cached past_key_values within this budget
+        prefix_cache_bytes = args['models'][model_name].get('prefix_cache_bytes', 0)
+        # Batched prompts are sorted by length and run in forward passes of at most this many padded tokens
+        max_tokens_per_batch = args['models'][model_name].get('max_tokens_per_batch')
         
         # Load model and tokenizer
         if device:
             num_gpus = torch.cuda.device_count()
 
-            print("Loading model:", model_name)
-            model, tokenizer = load_model_tokenizer(os.path.join(MODEL_PATH, model_name), device, num_gpus, )
-            if not model:
-                continue
+            if models is not None and model_name in models:
+                model, tokenizer = models[model_name]
             else:
-                print(f'Model {model_name} loaded')
+                print("Loading model:", model_name)
+                model, tokenizer = load_model_tokenizer(os.path.join(MODEL_PATH, model_name), device, num_gpus, )
+                if not model:
+                    continue
+                else:
+                    print(f'Model {model_name} loaded')
+            # Option letter tokens are resolved once per tokenizer and shared by every scorer
+            get_option_token_table(tokenizer)
+            prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes else None
+            # Option-token probabilities are reused across runs of the same snapshot and dtype
+            logits_cache = None
+            if args['logits_cache']:
+                snapshot_hash = os.path.basename(os.path.normpath(get_snapshot_path(os.path.join(MODEL_PATH, model_name))))
+                logits_cache = LogitsCache(args['logits_cache'], f'{model_name}:{snapshot_hash}:{model.dtype}')
+            # Prompts are tokenized once per tokenizer family and read back from the store
+            token_store = None
+            if args['token_store']:
+                fingerprint = tokenizer_fingerprint(tokenizer, get_chat_type(model_name))
+                if fingerprint not in token_stores:
+                    token_stores[fingerprint] = TokenStore(args['token_store'], fingerprint)
+                token_store = token_stores[fingerprint]
+            scheduler = LengthBucketScheduler(max_tokens_per_batch) if batch_size > 1 else None
         else:
-            client = GPTClient()
+            # Shared by every thread evaluating this deployment
+            rate_limiter = get_rate_limiter(model_name, args['models'][model_name].get('requests_per_minute'), args['models'][model_name].get('tokens_per_minute'))
+            if max_concurrency > 1:
+                client = AsyncGPTClient(rate_limiter=rate_limiter, response_cache=response_cache)
+                event_loop = asyncio.new_event_loop()
+            else:
+                client = GPTClient(rate_limiter=rate_limiter, response_cache=response_cache)
+            prefix_cache = None
+            logits_cache = None
+            token_store = None
+            scheduler = None
         
 
-        # Setup parameter grid
-        param_grid = ParameterGrid([
-            {
-                'num_shots': [
-                    0,
-                    # 1, 
-                    # 2, 
-                    # 5
-                ], 
-                'allow_explanation': [False], 
-                'question_type': [
-                    'mc',
-                    'mc-separate'
-                ], 
-                'num_sample': [args['num_sample']]
-            }, 
-            # {
-            #     'num_shots': [
-            #         0, 
-            #         1, 
-            #         2, 
-            #         5
-            #     ], 
-            #     'allow_explanation': [True], 
-            #     'question_type': [
-            #         'explanation',
-            #         'sequential-hidden', 
-            #         'sequential-shown'
-            #     ], 
-            #     'num_sample': [args['num_sample']]
-            # }
-            ])
-        
-        questions_df, questions_metadata, options_df, answers_df = get_uncompleted_dfs([QUESTIONS_DF, QUESTIONS_METADATA, OPTIONS_DF, ANSWERS_DF], results_df['question_id'].tolist())
+        param_grid = get_param_grid(args)
         
-        # Running inference
-        for params in param_grid:
-            test_metadata = questions_metadata.iloc[questions_df.query("explanation == False").index]
-            sampled_df = test_metadata.groupby(['type', 'domain', 'difficulty_level']).sample(n=params['num_sample'], random_state=42)
-            sampled_qids = set(sampled_df['question_id'])
-
-            # Filtered DataFrames based on sampled question_ids
-            filtered_questions_df = questions_df.query("question_id in @sampled_qids")
-            filtered_options_df = options_df.query("question_id in @sampled_qids")
-
-            base_ids = set(question_id.split('_')[0] for question_id in sampled_qids)
-
-            # iterate over questions by id
-            for run_num, base_id in enumerate(progress_bar(base_ids, desc=str(params), dynamic_ncols=True)):
-                # build prefix for few-shot prompting
-                task_data = questions_metadata.query(f"question_id == '{base_id}_0'").to_dict('records')[0]
-                prefix = build_prefix(task_data, questions_df, options_df, questions_metadata, answers_df, params)
-
-                # build question string
-                test_questions, test_options, permutations = get_test_questions(base_id, filtered_questions_df, filtered_options_df, params)
-
-                # Track total time to run inference on a model
-                start_time = time.time()
-
-                # Get model answer for question
-                if device:
-                    model_explanations, model_answers, probabilities = get_response_hf(
-                        model=model, 
-                        tokenizer=tokenizer, 
-                        device=device, 
-                        prefix=prefix, 
-                        questions=test_questions, 
-                        question_type=params['question_type'],
-                        options_lst=test_options,
-                        chat_type=get_chat_type(model_name)
-                    )
+        # Running inference. Results buffered for the checkpoint are written out even if the loop raises (e.g. CUDA OOM
+        # or CacheMissError), so a rerun resumes after them
+        try:
+            for params in param_grid:
+                # Drawn once per task from the stratification index and shared by every grid point and model
+                sampled_qids, sampled_base_ids = context.sample(params['num_sample'])
+
+                # The sample is seeded, so on resume only the base_ids without checkpointed results are left to run
+                completed_base_ids = get_completed_base_ids(results_df, params)
+                base_ids = list(sampled_base_ids - completed_base_ids)
+
+                # Independent prompts of local models are scored batch_size base_ids at a time
+                batched = device is not None and batch_size > 1 and params['question_type'] in HF_BATCH_RESPONSE
+                concurrent = device is None and max_concurrency > 1
+                if batched:
+                    step = batch_size
+                elif concurrent:
+                    # Enough base_ids per step that requests stay in flight while results are recorded
+                    step = max_concurrency * 4
                 else:
-                    try:
-                        model_explanations, model_answers, probabilities = get_response(
-                            client=client, 
-                            model=model_name,
-                            prefix=prefix, 
-                            questions=test_questions, 
+                    step = 1
+
+                # iterate over questions by id
+                progress = progress_bar(total=len(base_ids), desc=str(params), dynamic_ncols=True)
+                for run_num, batch_start in enumerate(range(0, len(base_ids), step)):
+                    batch = []
+                    for base_id in base_ids[batch_start:batch_start + step]:
+                        # build prefix for few-shot prompting
+                        task_data = dict(element_store.get_metadata(f'{base_id}_0'))
+                        prefix = build_prefix(task_data, exemplar_pool, params, seed=args['prefix_seed'])
+
+                        # build question string
+                        random_state = get_question_random_state(args['seed'], base_id)
+                        test_questions, test_options, permutations = get_test_questions(base_id, element_store, params, question_ids=sampled_qids, random_state=random_state, prompt_cache=prompt_cache)
+                        batch.append((base_id, task_data, prefix, test_questions, test_options, permutations))
+
+                    # Track total time to run inference on a model
+                    start_time = time.time()
+
+                    # Get model answer for question
+                    if batched:
+                        responses = get_response_hf_batch(
+                            model=model,
+                            tokenizer=tokenizer,
+                            device=device,
+                            prefixes=[prefix for _, _, prefix, _, _, _ in batch],
+                            questions_lst=[test_questions for _, _, _, test_questions, _, _ in batch],
                             question_type=params['question_type'],
-                            options_lst=test_options,
-                            chat_type=get_chat_type(model_name)
+                            options_lsts=[test_options for _, _, _, _, test_options, _ in batch],
+                            chat_type=get_chat_type(model_name),
+                            logits_cache=logits_cache,
+                            token_store=token_store,
+                            scheduler=scheduler
                         )
-                    except openai.BadRequestError as e:
-                        print(f"Error: {e}")
-                        continue
-
-
-                inference_time = time.time() - start_time
-
-                # Reverse permutation answer
-                # Permuted answers are the index value into the list of options
-                permuted_answers = permute_answer(model_answers=model_answers, permutations=permutations)
-
-                # Instantiate the results dataframe: num_shots, allow_explanation, etc.
-                result_params = params.copy()
-                # This is domain, type, difficulty_level
-                for data in task_data:
-                    result_params[data] = task_data[data]
-                result_params.pop('num_sample')
-                # Store results
-                results = [create_results_dict(
-                    params = result_params,
-                    task_name = args['task_name'],
-                    model_name = model_name,
-                    base_id = base_id,
-                    sub_id = i,
-                    permuted_answer = permuted_answer,
-                    model_answer = model_answers[i],
-                    model_explanation = model_explanations[i],
-                    probabilities = probabilities[i],
-                    permutations = permutations
-                ) for i, permuted_answer in enumerate(permuted_answers)]
-                
-                results_df = pd.concat([results_df, pd.DataFrame.from_records(results)], sort=False, ignore_index=True)
-                
-                result_metadata = [{
-                    'task_name': args['task_name'],
-                    'model_name': model_name,
-                    'question_id': f"{base_id}_{i}",
-                    'permutation': permutation,
-                    'prompt': test_questions,
-                    'inference_time': inference_time
-                    } for i, permutation in enumerate(permutations)]
-                results_metadata = pd.concat([results_metadata, pd.DataFrame.from_records(result_metadata)], sort=False, ignore_index=True)
-
-                if run_num % 10 == 0 and job_logger is not None:
-                    job_logger.log_groupby_counts(results_df, ['domain', 'difficulty_level', 'type', 'num_shots', 'allow_explanation'])
+                        # Inference time is shared evenly across the base_ids in the batch
+                        inference_times = [(time.time() - start_time) / len(batch)] * len(batch)
+                    elif concurrent:
+                        responses, inference_times = event_loop.run_until_complete(get_responses_async(
+                            client=client,
+                            model=model_name,
+                            prefixes=[prefix for _, _, prefix, _, _, _ in batch],
+                            questions_lst=[test_questions for _, _, _, test_questions, _, _ in batch],
+                            question_type=params['question_type'],
+                            options_lsts=[test_options for _, _, _, _, test_options, _ in batch],
+                            chat_type=get_chat_type(model_name),
+                            max_concurrency=max_concurrency
+                        ))
+                    else:
+                        responses, inference_times = [], []
+                        for base_id, task_data, prefix, test_questions, test_options, permutations in batch:
+                            start_time = time.time()
+                            if device:
+                                responses.append(get_response_hf(
+                                    model=model, 
+                                    tokenizer=tokenizer, 
+                                    device=device, 
+                                    prefix=prefix, 
+                                    questions=test_questions, 
+                                    question_type=params['question_type'],
+                                    options_lst=test_options,
+                                    chat_type=get_chat_type(model_name),
+                                    prefix_cache=prefix_cache,
+                                    logits_cache=logits_cache,
+                                    token_store=token_store
+                                ))
+                            else:
+                                try:
+                                    responses.append(get_response(
+                                        client=client, 
+                                        model=model_name,
+                                        prefix=prefix, 
+                                        questions=test_questions, 
+                                        question_type=params['question_type'],
+                                        options_lst=test_options,
+                                        chat_type=get_chat_type(model_name)
+                                    ))
+                                except openai.BadRequestError as e:
+                                    print(f"Error: {e}")
+                                    responses.append(None)
+                            inference_times.append(time.time() - start_time)
+
+                    for (base_id, task_data, prefix, test_questions, test_options, permutations), response, inference_time in zip(batch, responses, inference_times):
+                        if response is None:
+                            continue
+                        model_explanations, model_answers, probabilities = response
+
+                        # Reverse permutation answer
+                        # Permuted answers are the index value into the list of options
+                        permuted_answers = permute_answer(model_answers=model_answers, permutations=permutations)
+
+                        # Instantiate the results dataframe: num_shots, allow_explanation, etc.
+                        result_params = params.copy()
+                        # This is domain, type, difficulty_level
+                        for data in task_data:
+                            result_params[data] = task_data[data]
+                        result_params.pop('num_sample')
+                        # Store results
+                        results = [create_results_dict(
+                            context = context,
+                            params = result_params,
+                            model_name = model_name,
+                            base_id = base_id,
+                            sub_id = i,
+                            permuted_answer = permuted_answer,
+                            model_answer = model_answers[i],
+                            model_explanation = model_explanations[i],
+                            probabilities = probabilities[i],
+                            permutations = permutations
+                        ) for i, permuted_answer in enumerate(permuted_answers)]
+                    
+                        results_buffer.extend(results)
+                        group_counts.update(tuple(result[column] for column in COUNT_COLUMNS) for result in results)
+                    
+                        result_metadata = [{
+                            'task_name': args['task_name'],
+                            'model_name': model_name,
+                            'question_id': f"{base_id}_{i}",
+                            'permutation': permutation,
+                            'prompt': test_questions,
+                            'inference_time': inference_time
+                            } for i, permutation in enumerate(permutations)]
+                        metadata_buffer.extend(result_metadata)
+                        checkpoint_writer.add(results, result_metadata)
+
+                    progress.update(len(batch))
+                    if run_num % 10 == 0 and job_logger is not None:
+                        job_logger.log_counts(group_counts, COUNT_COLUMNS)
+                progress.close()
+        finally:
+            checkpoint_writer.flush()
         
-        # Save per model
-        if not os.path.exists(args['output_path']):
-            os.mkdir(args['output_path'])
-        results_df.to_pickle(results_path)
-        results_metadata.to_pickle(metadata_path)
-
-
-def run_evaluation(input_path: str, api: bool):
-    args = read_as_defaultdict(input_path)
+        if prefix_cache is not None:
+            print(f'Prefix cache for {model_name}: {prefix_cache.stats()}')
+        if logits_cache is not None:
+            print(f'Logits cache for {model_name}: {logits_cache.stats()}')
+            logits_cache.close()
+        if scheduler is not None:
+            print(f'Batch scheduler for {model_name}: {scheduler.stats()}')
+        if token_store is not None:
+            token_store.flush()
+            print(f'Token store for {model_name}: {token_store.stats()}')
+        if not device and max_concurrency > 1:
+            if client.client is not None:
+                event_loop.run_until_complete(client.client.close())
+            event_loop.close()
+
+        # New results are scored in one pass
+        results_df = pd.concat([results_df, score_results(results_buffer.to_frame(), element_store)], sort=False, ignore_index=True)
+        results_metadata = pd.concat([results_metadata, metadata_buffer.to_frame()], sort=False, ignore_index=True)
+
+        # Save per model, replacing the checkpoint segments
+        consolidate_segments(results_df, results_metadata, results_path, metadata_path, checkpoint_dir)
+
+    if response_cache is not None:
+        print(f"Response cache for {args['task_name']}: {response_cache.stats()}")
+        response_cache.close()
+    for token_store in token_stores.values():
+        token_store.close()
+
+
+def pretokenize_task(context, tokenizer, chat_type, token_store):
+    """
+    Tokenizes the prompts eval_models will score for a task into a TokenStore, without loading a model.
+
+    The sampled base_ids and their first-turn mc and mc-separate prompts are rebuilt exactly as eval_models builds
+    them. This needs the option shuffles to be seeded with the top-level seed, and the few-shot prefixes with
+    prefix_seed when there are shots. Grid points where a prompt would be drawn from numpy's global state are skipped.
+    Later turns include the model's answers to the previous sub-questions, so they are tokenized during evaluation.
+
+    Returns:
+        int: The number of prompts tokenized.
+    """
+    args = context.args
+    element_store = context.element_store
+    if args['seed'] is None:
+        print(f"Skipping {context.task_name}: prompts can only be pre-tokenized when the top-level seed is set")
+        return 0
+    prompt_cache, exemplar_pool = get_prompt_caches(context)
+
+    num_prompts = 0
+    for params in get_param_grid(args):
+        if params['question_type'] not in ('mc', 'mc-separate'):
+            continue
+        if params['num_shots'] > 0 and args['prefix_seed'] is None:
+            print(f"Skipping {params}: few-shot prefixes can only be pre-tokenized when prefix_seed is set")
+            continue
+        sampled_qids, sampled_base_ids = context.sample(params['num_sample'])
+        for base_id in sorted(sampled_base_ids):
+            task_data = dict(element_store.get_metadata(f'{base_id}_0'))
+            prefix = build_prefix(task_data, exemplar_pool, params, seed=args['prefix_seed'])
+            random_state = get_question_random_state(args['seed'], base_id)
+            test_questions, test_options, _ = get_test_questions(base_id, element_store, params, question_ids=sampled_qids, random_state=random_state, prompt_cache=prompt_cache)
+            if not test_questions:
+                continue
+            prompt = append_question(reconstruct_context(prefix, [], [], chat_type), test_questions[0], chat_type)
+            if params['question_type'] == 'mc':
+                prompts = [prompt]
+            else:
+                prompts = get_option_prompts(prompt, test_options[0], chat_type)
+            for prompt in prompts:
+                encode_prompt(tokenizer, prompt, chat_type, token_store)
+            num_prompts += len(prompts)
+    token_store.flush()
+    return num_prompts
 
-    global QUESTIONS_DF, QUESTIONS_METADATA, OPTIONS_DF, ANSWERS_DF
-    QUESTIONS_DF, QUESTIONS_METADATA, OPTIONS_DF, ANSWERS_DF = load_dfs(args['task_path'])
 
+def run_evaluation(input_path: str, api: bool, models=None, model_names=None, context=None):
+    # A caller evaluating the task with several models passes its context, so the elements and per-task caches are kept
+    if context is None:
+        args = read_as_defaultdict(input_path)
+        context = EvaluationContext(args, ElementStore(*load_dfs(args['task_path'])))
 
     if api:
-        eval_models(args, api)
+        eval_models(context, api, model_names=model_names)
     else:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         print('device:', device)
         with torch.inference_mode():
-            eval_models(args, False, device)
+            eval_models(context, False, device, models, model_names)
 
 
 def dir_path(string):
@@ -1,6 +1,7 @@
 import logging
 from tqdm import tqdm
 import os
+import pandas as pd
 class JobLogger:
     def __init__(self, file_path):
         self.file_path = file_path
@@ -63,3 +64,15 @@ class JobLogger:
         self.log_info(f"Counts data saved to {output_csv_path}")
 
         return grouped_df
+
+    def log_counts(self, counts, groupby_cols):
+        # Same output as log_groupby_counts, from counts of the groupby_cols values that are kept up to date by the caller
+        grouped_df = pd.DataFrame([key + (count,) for key, count in counts.items()], columns=groupby_cols + ['counts'])
+        grouped_df = grouped_df.sort_values(groupby_cols).reset_index(drop=True)
+
+        output_csv_path = os.path.join(self.file_path, 'grouped_counts.csv')
+        grouped_df.to_csv(output_csv_path, index=False)
+
+        self.log_info(f"Counts data saved to {output_csv_path}")
+
+        return grouped_df
\ No newline at end of file
@@ -1,31 +1,63 @@
 # Built-in packages
+import asyncio
+import json
 import os
 from typing import Optional
 from collections import defaultdict
 from math import exp
 # External packages
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+from openai.types.chat import ChatCompletion
 from transformers import AutoTokenizer, AutoModel, AutoModelForCausalLM
 import torch
 from accelerate import Accelerator
 # Local packages
 from utils.utils import get_gpu_memory, normalize_dict
+from utils.rate_limit_utils import estimate_tokens
+from utils.cache_utils import hash_request
+
+def parse_answer(response, valid_tokens):
+    """
+    Extracts the probabilities of the valid option tokens from the top logprobs of a single-token completion.
+
+    Returns:
+    - str, dict: The most likely valid token and the normalized probabilities of the valid tokens.
+    """
+    top_responses = response.choices[0].logprobs.content[0].top_logprobs
+    output = defaultdict(lambda: 0)
+    for logprob in top_responses:
+        for valid_token in valid_tokens:
+            if valid_token.startswith(logprob.token.upper()):
+                output[logprob.token] = exp(logprob.logprob)*100
+        if len(output) == len(valid_tokens):
+            break
+    output = normalize_dict(output)
+    return max(output, key=output.get), output
+
 
 class GPTClient:
-    def __init__(self, client='azure'):
-        if client.lower() == 'azure':
-            self.client = AzureOpenAI(
+    # Client class per API, replaced by their asyncio counterparts in AsyncGPTClient
+    CLIENT_CLASSES = {'azure': AzureOpenAI, 'openai': OpenAI}
+
+    def __init__(self, client='azure', rate_limiter=None, response_cache=None):
+        self.rate_limiter = rate_limiter
+        self.response_cache = response_cache
+        # Replaying from a read-only cache never reaches the API
+        if response_cache is not None and response_cache.read_only:
+            self.client = None
+        elif client.lower() == 'azure':
+            self.client = self.CLIENT_CLASSES['azure'](
                 api_key=os.environ['AZURE_OPENAI_API_KEY'],  
                 api_version="2024-02-01",
                 azure_endpoint = os.environ['AZURE_OPENAI_ENDPOINT']
             )
         elif client.lower() == 'openai':
-            self.client = OpenAI(
+            self.client = self.CLIENT_CLASSES['openai'](
                 api_key=os.environ['OPENAI_API_KEY']
             )
-    
-    def get_completion(
-        self,
+
+    @staticmethod
+    def build_params(
         messages: list[dict[str, str]],
         model: str = "gpt-4-1106-preview",
         max_tokens=500,
@@ -35,7 +67,7 @@ class GPTClient:
         tools=None,
         logprobs=None,  # whether to return log probabilities of the output tokens or not. If true, returns the log probabilities of each output token returned in the content of message..
         top_logprobs=None,
-    ) -> str:
+    ) -> dict:
         params = {
             "model": model,
             "messages": messages,
@@ -48,69 +80,99 @@ class GPTClient:
         }
         if tools:
             params["tools"] = tools
+        return params
 
-        completion = self.client.chat.completions.create(**params)
+    def lookup(self, params):
+        """
+        Returns the cache key of a request and its cached completion, or None if it has to be sent.
+        """
+        if self.response_cache is None:
+            return None, None
+        cache_key = hash_request(params)
+        cached = self.response_cache.get(cache_key)
+        return cache_key, (ChatCompletion.model_validate_json(cached) if cached is not None else None)
+
+    def estimate_tokens(self, params):
+        return estimate_tokens(params['messages']) + (params['max_tokens'] or 0)
+
+    def record(self, cache_key, estimated_tokens, completion):
+        """
+        Settles the token budget with the usage of a completion and stores it in the response cache.
+        """
+        if self.rate_limiter is not None and completion.usage is not None:
+            self.rate_limiter.settle(estimated_tokens, completion.usage.total_tokens)
+        if self.response_cache is not None:
+            self.response_cache.put(cache_key, completion.model_dump_json())
         return completion
 
-    def get_explanation(
-        self,
-        messages: list[dict[str, str]],
-        model: str = 'gpt-4',
-        max_tokens = 500,
-        temperature = 0,
-        stop = None,
-        seed = 123, 
-        tools = None,
-        logprobs = None,
-        top_logprobs=None,
-    ) -> str:
-        response = self.get_completion(
-            messages,
-            model,
-            max_tokens,
-            temperature,
-            stop,
-            seed,
-            tools,
-            logprobs,
-            top_logprobs
-        )
+    @staticmethod
+    def answer_kwargs(kwargs):
+        # Azure currently only supports top 5 logprobs
+        return {**kwargs, 'top_logprobs': min(5, kwargs['top_logprobs'])}
+
+    def get_completion(self, messages, **kwargs) -> str:
+        params = self.build_params(messages, **kwargs)
+
+        # Identical requests are served from the response cache
+        cache_key, cached = self.lookup(params)
+        if cached is not None:
+            return cached
+
+        # Wait for the deployment's request and token budget before sending
+        estimated_tokens = self.estimate_tokens(params)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(estimated_tokens)
+
+        completion = self.client.chat.completions.create(**params)
+        return self.record(cache_key, estimated_tokens, completion)
+
+    def get_explanation(self, messages, **kwargs) -> str:
+        """
+        Takes the keyword arguments of build_params and returns the text of the completion.
+        """
+        response = self.get_completion(messages, **kwargs)
         return response.choices[0].message.content
     
-    def get_answer(
-        self,
-        valid_tokens,
-        messages: list[dict[str, str]],
-        model: str = 'gpt-4',
-        max_tokens = 500,
-        temperature = 0,
-        stop = None,
-        seed = 123, 
-        tools = None,
-        logprobs = None,
-        top_logprobs=None,
-    ) -> dict:
-        response = self.get_completion(
-            messages,
-            model,
-            max_tokens,
-            temperature,
-            stop,
-            seed,
-            tools,
-            logprobs,
-            min(5, top_logprobs) # Azure currently only supports top 5 logprobs
-        )
-        top_responses = response.choices[0].logprobs.content[0].top_logprobs
-        output = defaultdict(lambda: 0)
-        for logprob in top_responses:
-            for valid_token in valid_tokens:
-                if valid_token.startswith(logprob.token.upper()):
-                    output[logprob.token] = exp(logprob.logprob)*100
-            if len(output) == len(valid_tokens):
-                break
-        output = normalize_dict(output)
-        return max(output, key=output.get), output 
+    def get_answer(self, valid_tokens, messages, **kwargs) -> dict:
+        """
+        Takes the keyword arguments of build_params (top_logprobs is required) and returns the most likely valid token
+        with the normalized probabilities of the valid tokens.
+        """
+        response = self.get_completion(messages, **self.answer_kwargs(kwargs))
+        return parse_answer(response, valid_tokens)
+
+
+class AsyncGPTClient(GPTClient):
+    """
+    Asyncio counterpart of GPTClient, so that many requests can be in flight from a single thread. Requests are built,
+    cached and parsed by the GPTClient helpers; the calls to the API and the rate limiter are awaited, and the response
+    cache's SQLite reads and writes run in worker threads so they do not block the event loop.
+    """
+    CLIENT_CLASSES = {'azure': AsyncAzureOpenAI, 'openai': AsyncOpenAI}
+
+    async def get_completion(self, messages, **kwargs) -> str:
+        params = self.build_params(messages, **kwargs)
+
+        # Identical requests are served from the response cache
+        cache_key, cached = await asyncio.to_thread(self.lookup, params)
+        if cached is not None:
+            return cached
+
+        # Wait for the deployment's request and token budget before sending
+        estimated_tokens = self.estimate_tokens(params)
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire_async(estimated_tokens)
+
+        completion = await self.client.chat.completions.create(**params)
+        return await asyncio.to_thread(self.record, cache_key, estimated_tokens, completion)
+
+    async def get_explanation(self, messages, **kwargs) -> str:
+        response = await self.get_completion(messages, **kwargs)
+        return response.choices[0].message.content
+
+    async def get_answer(self, valid_tokens, messages, **kwargs) -> dict:
+        response = await self.get_completion(messages, **self.answer_kwargs(kwargs))
+        return parse_answer(response, valid_tokens)
 
 
     
@@ -160,11 +222,23 @@ def build_kwargs(device: str, num_gpus: int, max_gpu_mem: Optional[str] = None):
 
     return kwargs
 
+def get_snapshot_path(model_path: str):
+    """
+    Returns the path of the snapshot a model is loaded from. Its directory name is the hash of the model revision.
+    """
+    model_path = os.path.join(model_path, 'snapshots/')
+    return os.path.join(model_path, os.listdir(model_path)[0])
+
+def load_tokenizer(model_path: str):
+    """
+    Loads only the tokenizer of a local model, e.g. to pre-tokenize prompts without loading the weights.
+    """
+    return AutoTokenizer.from_pretrained(get_snapshot_path(model_path), local_files_only=True)
+
 def load_model_tokenizer(model_path: str, device: str = "cuda", num_gpus: int = 2, max_gpu_mem: Optional[str] = None):
     kwargs = build_kwargs(device, num_gpus, max_gpu_mem)
     
-    model_path = os.path.join(model_path, 'snapshots/')
-    model_path = os.path.join(model_path, os.listdir(model_path)[0])
+    model_path = get_snapshot_path(model_path)
     print('Loading model from:', model_path) 
     try:
         model, tokenizer = load_model(model_path, kwargs)
@@ -176,4 +250,27 @@ def load_model_tokenizer(model_path: str, device: str = "cuda", num_gpus: int =
     if (device == "cuda" and num_gpus == 1) and model != False:
         model.to(device)
 
-    return model, tokenizer
\ No newline at end of file
+    return model, tokenizer
+
+
+# Weights from_pretrained loads, in order of preference: the single-file name and the index of a sharded checkpoint
+WEIGHT_FILES = (('model.safetensors', 'model.safetensors.index.json'), ('pytorch_model.bin', 'pytorch_model.bin.index.json'))
+
+
+def estimate_model_memory(model_path: str):
+    """
+    Estimates the memory in bytes a local model needs from the size of the weight files from_pretrained loads from its
+    snapshot: safetensors if present, else PyTorch .bin. Other copies of the weights in the snapshot are not counted.
+    """
+    snapshot_path = get_snapshot_path(model_path)
+    names = os.listdir(snapshot_path)
+    for weights_name, index_name in WEIGHT_FILES:
+        if index_name in names:
+            with open(os.path.join(snapshot_path, index_name)) as f:
+                weight_names = set(json.load(f)['weight_map'].values())
+        elif weights_name in names:
+            weight_names = [weights_name]
+        else:
+            continue
+        return sum(os.path.getsize(os.path.join(snapshot_path, name)) for name in weight_names)
+    return 0
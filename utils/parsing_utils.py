@@ -1,4 +1,5 @@
 import re
+import weakref
 from string import ascii_lowercase, ascii_uppercase
 
 
@@ -48,41 +49,112 @@ def remove_answer_letter(text):
 #########################################################################################
 
 
+class TokenTrie:
+    """
+    Trie over the token ids of a set of allowed phrases.
+
+    Each node maps the next token id to its child, and the key None marks the end of a phrase. Decoding only ever needs
+    the tokens generated since the prompt, and a phrase is at most depth tokens long, so finding the node of a sequence
+    costs at most depth steps however long the sequence grows.
+    """
+    END = None
+
+    def __init__(self, sequences):
+        self.root = {}
+        self.depth = 0
+        for sequence in sequences:
+            node = self.root
+            for token_id in sequence:
+                node = node.setdefault(token_id, {})
+            node[self.END] = {}
+            self.depth = max(self.depth, len(sequence))
+        # id(node) -> allowed token ids, filled on first visit
+        self.allowed = {}
+
+    def walk(self, token_ids):
+        """
+        Returns the node reached by token_ids, or None once they leave the trie (e.g. after a completed phrase).
+        """
+        node = self.root
+        for token_id in token_ids:
+            node = node.get(int(token_id))
+            if node is None:
+                return None
+        return node
+
+    def get_allowed(self, node, eos_token_id):
+        """
+        Returns the token ids that may follow a node: its children, and eos_token_id where a phrase ends.
+        """
+        key = id(node)
+        if key not in self.allowed:
+            allowed = [token_id for token_id in node if token_id is not self.END]
+            if self.END in node and eos_token_id is not None:
+                allowed.append(eos_token_id)
+            self.allowed[key] = allowed
+        return self.allowed[key]
+
+
+# Rows that completed a phrase and left the trie may only continue with eos
+END_NODE = {TokenTrie.END: {}}
+# tokenizer -> {(kind, num_options): TokenTrie}, so the vocabulary is scanned once per tokenizer and option set
+TRIES = weakref.WeakKeyDictionary()
+# tokenizer -> ids of its whole vocabulary, allowed once an answer is free to continue
+VOCAB_IDS = weakref.WeakKeyDictionary()
+
+
+def normalize_token(token):
+    """Normalize tokens"""
+    return token.replace("Ġ", "").replace("\u2581", "").lower()
+
+
+def get_trie(tokenizer, kind, num_options):
+    """
+    Returns the TokenTrie of the first num_options answers, built once per tokenizer.
+
+    kind is 'phrases' for the encodings of the lowercase option letters, or 'letters' for every single token of the
+    vocabulary that reads as one of the letters (e.g. "A", "a", "ĠA").
+    """
+    tries = TRIES.setdefault(tokenizer, {})
+    key = (kind, num_options)
+    if key not in tries:
+        if kind == 'phrases':
+            sequences = [tokenizer.encode(phrase, add_special_tokens=False) for phrase in LETTERS[:num_options]]
+        else:
+            letters = set(LETTERS[:num_options])
+            sequences = [[token_id] for token, token_id in tokenizer.get_vocab().items() if normalize_token(token) in letters]
+        tries[key] = TokenTrie(sequences)
+    return tries[key]
+
+
+def get_prefix_allowed_tokens(tokenizer, input_str, trie, free_after_phrase):
+    """
+    Wraps a TokenTrie as a prefix_allowed_tokens_fn for model.generate.
+    """
+    input_len = len(tokenizer.encode(input_str))
+    if tokenizer not in VOCAB_IDS:
+        VOCAB_IDS[tokenizer] = list(tokenizer.get_vocab().values())
+    all_inputs = VOCAB_IDS[tokenizer]
+
+    def prefix_allowed_tokens(batchId, inputIds):
+        if free_after_phrase and len(inputIds) - input_len > trie.depth:
+            return all_inputs
+        node = trie.walk(inputIds[input_len:input_len + trie.depth + 1].tolist())
+        if free_after_phrase and (node is None or TokenTrie.END in node):
+            return all_inputs
+        if node is None:
+            node = END_NODE
+        return trie.get_allowed(node, tokenizer.eos_token_id)
+    return prefix_allowed_tokens
+
+
 # NOTE: not sure if restricting the output is a fair evaluation of an LLM.
 def restrict_phrases(input_str, tokenizer, num_options):
     """Restricts the answer to a fixed set of allowed phrases"""
-    # TODO: This implementation is inefficient, but there's plenty of obvious ways to speed it up
-    # https://discuss.huggingface.co/t/example-of-prefix-allowed-tokens-fn-while-text-generation/6635/2
-    def prefix_allowed_tokens(batchId, inputIds):
-        # Get the answer so far
-        decoded = tokenizer.decode(inputIds)[len(input_str):]
-        # How could we continue this into a phrase
-        phrases = [p[len(decoded):] for p in LETTERS[:num_options] if p.startswith(decoded)]
-        # What token comes next?
-        next_tokens = set(tokenizer.encode(p)[0] if p else tokenizer.eos_token_id for p in phrases)
-        return list(next_tokens)
-    return prefix_allowed_tokens
+    return get_prefix_allowed_tokens(tokenizer, input_str, get_trie(tokenizer, 'phrases', num_options), free_after_phrase=False)
 
 
 # NOTE: not sure if restricting the output is a fair evaluation of an LLM.
 def restrict_letters(input_str, tokenizer, num_options):
     """Only allows answers to start with A or B or .."""
-    input_len = len(tokenizer.encode(input_str))
-    vocab = tokenizer.get_vocab()
-    all_inputs = list(vocab.values())
-    
-    def normalize(t):
-        """Normalize tokens"""
-        return t.replace("Ġ", "").lower()
-
-    def get_inputs(f):
-        """Gets all input ids with tokens matching a function"""
-        return [v for (k,v) in vocab.items() if f(k)]
-    
-    letter_inputs = get_inputs(lambda t: normalize(t) in LETTERS[:num_options])
-    def prefix_allowed_tokens(batchId, inputIds):
-        if len(inputIds) > input_len:
-            return all_inputs
-        return letter_inputs
-    
-    return prefix_allowed_tokens
+    return get_prefix_allowed_tokens(tokenizer, input_str, get_trie(tokenizer, 'letters', num_options), free_after_phrase=True)
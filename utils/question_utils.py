@@ -1,6 +1,8 @@
 from string import ascii_lowercase, ascii_uppercase
+import zlib
 ALPHABET = list(ascii_uppercase)
 
+import numpy as np
 import pandas as pd
 
 from utils.utils import get_option_letters, flatten_list
@@ -11,6 +13,27 @@ SUFFIX_OPTIONS = {
     'explanation': "\nBriefly explain your reasoning in triple quotes.",
 }
 
+def compile_template(*parts):
+    """
+    Joins literal parts and {question_text}/{options_str} fields into one format string, escaping braces in literals.
+    """
+    return ''.join(part if part in ('{question_text}', '{options_str}') else part.replace('{', '{{').replace('}', '}}') for part in parts)
+
+# question_type -> format strings of the turns a question is split into
+PROMPT_TEMPLATES = {
+    'mc': [compile_template('{question_text}', '\n', '{options_str}', '\n', SUFFIX_OPTIONS['mc'])],
+    'mc-separate': [compile_template('{question_text}', '\n', '{options_str}', '\n', SUFFIX_OPTIONS['mc'])],
+    'explanation': [compile_template('{question_text}', '\n', '{options_str}', '\n', SUFFIX_OPTIONS['explain-answer'])],
+    'sequential-shown': [
+        compile_template('{question_text}', '\n', '{options_str}', '\n', SUFFIX_OPTIONS['explanation']),
+        compile_template('{options_str}', '\n', SUFFIX_OPTIONS['mc']),
+    ],
+    'sequential-hidden': [
+        compile_template('{question_text}', '\n', SUFFIX_OPTIONS['explanation']),
+        compile_template('{options_str}', '\n', SUFFIX_OPTIONS['mc']),
+    ],
+}
+
 
 #########################################################################################
 ##                                                                                     ##
@@ -91,19 +114,34 @@ def append_question(context, question, chat_type):
     return context
 
 
-def shuffle_and_permute_options(options):
+def shuffle_and_permute_options(option_ids, option_texts, random_state=None):
     """
-    Shuffle the options DataFrame conditioned on a question_id
+    Shuffle the options of a question
+
+    The shuffle is drawn exactly as options_df.sample(frac=1, random_state=random_state) would draw it.
 
     Args:
-        options (pd.DataFrame): DataFrame containing options for a specific question.
+        option_ids (list): The option_ids of the question, in their original order.
+        option_texts (list): The option texts, in the same order.
+        random_state (np.random.RandomState, optional): Source of the shuffle. Defaults to numpy's global state.
 
     Returns:
-        pd.DataFrame, list: the shuffled options DataFrame and a permutation
+        list, list: the shuffled option texts and the permutation of option_ids
+    """
+    random_state = np.random if random_state is None else random_state
+    order = random_state.choice(len(option_ids), size=len(option_ids), replace=False)  # Shuffle options
+    return [option_texts[i] for i in order], [option_ids[i] for i in order]
+
+def get_question_random_state(seed, base_id):
     """
-    options_shuffled = options.sample(frac=1)  # Shuffle options
-    permutation = options_shuffled.option_id.tolist()  # Get the permutation
-    return options_shuffled, permutation
+    Returns the RandomState the options of a base_id are shuffled with, or None to use numpy's global state.
+
+    The state only depends on the seed and the base_id, so every model, rerun and pre-tokenization pass of a task sees
+    the same prompts for the base_id regardless of the order base_ids are evaluated in.
+    """
+    if seed is None:
+        return None
+    return np.random.RandomState(zlib.crc32(f'{seed}:{base_id}'.encode('utf-8')))
 
 def reshape_alphabet(permutations):
     new_2d = []
@@ -141,24 +179,20 @@ def convert_probabilities(probabilities, q_id, permutations):
     probabilities_list = [probabilities[key] for key in sorted(probabilities.keys())]
     return [probabilities_list[i] for i in permutations[q_id]]
 
-def build_options_string(options, start_index):
+def build_options_string(option_texts, start_index):
     """
     Construct a string representing question options with global labels, and return updated global option index.
 
     Args:
-        options (pd.DataFrame): DataFrame containing options for a specific question.
-        alphabet (str): String containing the alphabet used for labeling options.
+        option_texts (list): The texts of the options of a question, in the order they are shown.
         start_index (int): Starting index for global option labeling.
 
     Returns:
         str, int: A string of options labeled with globally unique characters from the alphabet,
                   and the updated global option index after processing these options.
     """
-    options_str = ""
-    for i, option in enumerate(options.itertuples(), start=start_index):
-        label = ALPHABET[i % len(ALPHABET)]
-        options_str += f"{label}. {option.option_text}\n"
-    updated_global_option_index = start_index + len(options)
+    options_str = '\n'.join([f"{ALPHABET[i % len(ALPHABET)]}. {option_text}" for i, option_text in enumerate(option_texts, start=start_index)])
+    updated_global_option_index = start_index + len(option_texts)
     return options_str.strip(), updated_global_option_index
 
 def format_question(question_text, options_str, params):
@@ -174,26 +208,36 @@ def format_question(question_text, options_str, params):
         list: A list containing formatted question strings.
     """
     question_type = params.get('question_type', 'mc')  # Default to 'mc' if not specified
-    question_variants = []
-
-    if question_type == 'mc' or question_type == 'mc-separate':
-        suffix = SUFFIX_OPTIONS.get('mc')
-        question_variants.append(f"{question_text}\n{options_str}\n{suffix}")
-    elif question_type == 'explanation':
-        suffix = SUFFIX_OPTIONS.get('explain-answer')
-        question_variants.append(f"{question_text}\n{options_str}\n{suffix}")
-    elif question_type == 'sequential-shown':
-        suffix = SUFFIX_OPTIONS.get('explanation')
-        question_variants.append(f"{question_text}\n{options_str}\n{suffix}")
-        suffix = SUFFIX_OPTIONS.get('mc')
-        question_variants.append(f"{options_str}\n{suffix}")
-    elif question_type == 'sequential-hidden':
-        suffix = SUFFIX_OPTIONS.get('explanation')
-        question_variants.append(f"{question_text}\n{suffix}")
-        suffix = SUFFIX_OPTIONS.get('mc')
-        question_variants.append(f"{options_str}\n{suffix}")
-    
-    return question_variants
+    return [template.format(question_text=question_text, options_str=options_str) for template in PROMPT_TEMPLATES.get(question_type, [])]
+
+class PromptCache:
+    """
+    Memo of rendered questions keyed by (question_id, permutation, question_type, start_index).
+
+    The same question is shown with the same permutation of its options at many grid points and to many models, and
+    every rendering of it is the same list of strings, so it is built once per task.
+    """
+    def __init__(self):
+        self.prompts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, question_id, question_text, option_texts, permutation, start_index, params):
+        """
+        Returns the formatted turns of a question whose options are shown in the given order starting at start_index.
+        """
+        key = (question_id, tuple(permutation), params.get('question_type', 'mc'), start_index)
+        prompt = self.prompts.get(key)
+        if prompt is None:
+            self.misses += 1
+            options_str, _ = build_options_string(option_texts, start_index)
+            prompt = self.prompts[key] = format_question(question_text, options_str, params)
+        else:
+            self.hits += 1
+        return prompt
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.prompts)}
 
 def add_answer(question, answer, params):
     question_type = params.get('question_type', 'mc')  # Default to 'mc' if not specified
@@ -219,17 +263,19 @@ def merge_dfs(questions_df, options_df, questions_metadata=None, answers_df=None
         return options_df.merge(questions_df, on='question_id', how='left').merge(questions_metadata, on='question_id', how='left')
     return pd.merge(options_df, questions_df, on='question_id', how='left')
 
-def get_test_questions(q_id, questions_df, options_df, params):
+def get_test_questions(q_id, element_store, params, question_ids=None, random_state=None, prompt_cache=None):
     """
     Generate formatted test questions and their options based on specified parameters, including permutations of options.
 
     Args:
         q_id (str): Base question ID used to filter related questions.
-        questions_df (pd.DataFrame): DataFrame containing question details.
-        options_df (pd.DataFrame): DataFrame containing option details for questions.
+        element_store (ElementStore): Index over the element's questions, options and answers.
         params (dict): Dictionary containing parameters for question formatting.
                        Expected keys are:
                        - 'question_type': Specifies the format of the questions and options.
+        question_ids (set, optional): If given, only sub-questions whose question_id is in this set are used.
+        random_state (np.random.RandomState, optional): Source of the option shuffles. Defaults to numpy's global state.
+        prompt_cache (PromptCache, optional): Memo the formatted questions are taken from and added to.
 
     Returns:
         list, list, list: A tuple containing three lists:
@@ -240,46 +286,50 @@ def get_test_questions(q_id, questions_df, options_df, params):
     Each question's options are permuted randomly, and the permutation is returned along with the formatted questions.
     """
     
-    related_questions = questions_df[questions_df['question_id'].str.startswith(f"{q_id}_")]
     test_questions, test_options = [] ,[]
     options_permutations = []  # To track permutations of options for each question
     global_option_index = 0
 
-    for _, question in related_questions.iterrows():
-        question_id = question['question_id']
-        question_text = question['question_text']
-        options = options_df[options_df['question_id'] == question_id]
+    for question_id in element_store.get_sub_question_ids(q_id):
+        if question_ids is not None and question_id not in question_ids:
+            continue
+        question_text = element_store.get_question(question_id)['question_text']
+        option_ids, option_texts = element_store.get_option_lists(question_id)
         
         # Shuffle options and generate permutation
-        options, permutation = shuffle_and_permute_options(options)
-        test_options.append(options.option_text.tolist())
-        options_str, updated_global_option_index = build_options_string(options, global_option_index)
-        
-        # Update global option index
-        global_option_index = updated_global_option_index
+        option_texts, permutation = shuffle_and_permute_options(option_ids, option_texts, random_state)
+        test_options.append(option_texts)
 
         # Store the permutation
         options_permutations.append(permutation)
 
-        formatted_question = format_question(question_text, options_str, params)
+        if prompt_cache is not None:
+            formatted_question = prompt_cache.render(question_id, question_text, option_texts, permutation, global_option_index, params)
+        else:
+            options_str, _ = build_options_string(option_texts, global_option_index)
+            formatted_question = format_question(question_text, options_str, params)
         test_questions.extend(formatted_question)
 
+        # Update global option index
+        global_option_index += len(option_texts)
+
     return test_questions, test_options, options_permutations
 
-def build_prefix_string(base_id, questions_df, options_df, answers_df, params):
+def build_prefix_string(base_id, element_store, params, random_state=None, prompt_cache=None):
     
-    prefix_questions, _, permutations = get_test_questions(base_id, questions_df, options_df, params)
+    prefix_questions, _, permutations = get_test_questions(base_id, element_store, params, random_state=random_state, prompt_cache=prompt_cache)
+    sub_question_ids = element_store.get_sub_question_ids(base_id)
 
     # flattened list of option letters permuted on each sub_id
     option_letters = flatten_list([[options[i] for i in permutation] for options, permutation in zip(get_option_letters(permutations), permutations)])
     # n-hot encoding of the correct answer indices
-    correct_answer_indices = answers_df[answers_df['question_id'].str.startswith(f"{base_id}_")]['correct_answer'].tolist()
+    correct_answer_indices = flatten_list([element_store.get_answers(question_id) for question_id in sub_question_ids])
 
     # Correct option letters
     correct_answers = [element for element, flag in zip(option_letters, correct_answer_indices) if flag == 1]
 
     # get explanations
-    explanations = questions_df[questions_df['question_id'].str.startswith(f"{base_id}_")]['explanation'].tolist()
+    explanations = [element_store.get_question(question_id)['explanation'] for question_id in sub_question_ids]
     answers = [(explanations[i], correct_answers[i]) for i in range(len(correct_answers))]
     
     # add answers and/or explanations to the prefix
@@ -290,12 +340,73 @@ def build_prefix_string(base_id, questions_df, options_df, answers_df, params):
     return prefix_string
 
 
-def build_prefix(task_data, questions_df, options_df, questions_metadata, answers_df, params):
+# Columns whose value combinations (cells) exemplars are drawn from
+EXEMPLAR_CELL_COLUMNS = ['type', 'domain', 'difficulty_level']
 
-    # get num_shots number of prefix questions by question_id
-    prefix_question_ids = questions_df.query('explanation != False').merge(questions_metadata, on='question_id', how='left').query("type == @task_data['type'] and domain == @task_data['domain'] and difficulty_level == @task_data['difficulty_level']").sample(n=params['num_shots'])['question_id'].tolist()
-    
-    # Get base ids
-    base_ids = set(question_id.split('_')[0] for question_id in prefix_question_ids)
+class ExemplarPool:
+    """
+    The few-shot exemplars of a task grouped by (type, domain, difficulty_level) cell, built once.
+
+    Exemplars are the questions with an explanation. Each cell keeps their question_ids in the order of questions_df,
+    so drawing num_shots of them with numpy's global random state gives the same exemplars as sampling the merged
+    frame did.
 
-    return '\n\n'.join([build_prefix_string(base_id, questions_df, options_df, answers_df, params) for base_id in base_ids])
\ No newline at end of file
+    Without a seed, every question draws its own exemplars and option shuffles from numpy's global random state, as the
+    merge-and-sample draw did, so its prefix is rendered for it and never cached: finding the cell's exemplars is a
+    dict lookup, but rendering them is done per question. This keeps the exemplars varied across the questions of a
+    cell, which is intended.
+
+    When a seed is given, the exemplars and the shuffles of their options come from a RandomState seeded with it, and
+    the rendered prefix is cached per (cell, num_shots, question_type, allow_explanation, seed). Every base_id of a
+    cell then shares one prefix, and building it again is a dict lookup.
+    """
+    def __init__(self, element_store, prompt_cache=None):
+        self.element_store = element_store
+        self.prompt_cache = prompt_cache
+        exemplars = element_store.questions_df.query('explanation != False').merge(element_store.questions_metadata, on='question_id', how='left')
+        question_ids = exemplars['question_id'].to_numpy(dtype=object)
+        self.cells = {cell: question_ids[positions] for cell, positions in exemplars.groupby(EXEMPLAR_CELL_COLUMNS, sort=False, observed=True).indices.items()}
+        self.prefixes = {}
+
+    def get_exemplar_ids(self, cell, num_shots, random_state=None):
+        question_ids = self.cells.get(cell, np.array([], dtype=object))
+        random_state = np.random if random_state is None else random_state
+        return question_ids[random_state.choice(len(question_ids), size=num_shots, replace=False)].tolist()
+
+    def get_prefix(self, cell, params, seed=None):
+        """
+        Returns the few-shot prefix of a cell: num_shots exemplars with their answers, rendered for params. Only seeded
+        prefixes are cached; without a seed a new prefix is drawn and rendered on every call.
+        """
+        if seed is None:
+            return self.render_prefix(cell, params)
+        key = (cell, params['num_shots'], params['question_type'], params.get('allow_explanation'), seed)
+        if key not in self.prefixes:
+            self.prefixes[key] = self.render_prefix(cell, params, np.random.RandomState(seed))
+        return self.prefixes[key]
+
+    def render_prefix(self, cell, params, random_state=None):
+        prefix_question_ids = self.get_exemplar_ids(cell, params['num_shots'], random_state)
+
+        # Get base ids
+        base_ids = set(question_id.split('_')[0] for question_id in prefix_question_ids)
+        if random_state is not None:
+            # Set order depends on string hashing, so it is fixed before drawing the option shuffles
+            base_ids = sorted(base_ids)
+
+        return '\n\n'.join([build_prefix_string(base_id, self.element_store, params, random_state, self.prompt_cache) for base_id in base_ids])
+
+
+def build_prefix(task_data, exemplar_pool, params, seed=None):
+    """
+    Builds the few-shot prefix of a question from the exemplars of its (type, domain, difficulty_level) cell.
+
+    Args:
+        task_data (dict): The metadata of the question, with its type, domain and difficulty_level.
+        exemplar_pool (ExemplarPool): The exemplars of the task.
+        params (dict): The grid point, with num_shots and question_type.
+        seed (int, optional): If given, the prefix is drawn with this seed, cached and shared by the whole cell.
+            Otherwise every question draws and renders its own prefix.
+    """
+    cell = tuple(task_data[column] for column in EXEMPLAR_CELL_COLUMNS)
+    return exemplar_pool.get_prefix(cell, params, seed)
@@ -0,0 +1,188 @@
+# Built-in packages
+import asyncio
+from multiprocessing.managers import BaseManager
+import threading
+import time
+
+
+#########################################################################################
+#########################################################################################
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+###                               Rate Limiting Code                                  ###
+###                                                                                   ###
+###                                                                                   ###
+###                                                                                   ###
+#########################################################################################
+#########################################################################################
+
+# Azure enforces per-minute quotas over 10 second windows, so a bucket never holds more than a sixth of a minute's budget
+BURST_FRACTION = 1 / 6
+# Fraction of the quota that is actually used, to stay just under it
+HEADROOM = 0.9
+# Rough number of characters per token for English prompts, and tokens added per chat message
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+# Proxy of the RateLimiterRegistry shared by the worker processes of run_script, or None when running in one process
+SHARED_REGISTRY = None
+
+
+def estimate_tokens(messages):
+    """
+    Estimates the number of prompt tokens of a list of chat messages without a tokenizer.
+    """
+    return sum(len(message['content']) // CHARS_PER_TOKEN + TOKENS_PER_MESSAGE for message in messages)
+
+
+class TokenBucket:
+    """
+    Token bucket that refills continuously at `rate` per second up to `capacity`.
+
+    Consuming more than is available leaves the bucket in debt, and the caller is told how long to wait until the
+    debt is paid back. Consecutive callers therefore queue up behind each other instead of all retrying at once.
+    """
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.last_refill = time.monotonic()
+
+    def consume(self, amount):
+        """
+        Takes amount out of the bucket and returns the number of seconds to wait before using it.
+        """
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Paces the requests to one deployment so they stay under its requests-per-minute and tokens-per-minute quotas.
+
+    A request reserves one request and its estimated tokens up front and sleeps until both budgets allow it. Once the
+    completion comes back, the difference between the estimate and the reported usage is settled. The limiter is
+    thread-safe and can be awaited from asyncio code.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.lock = threading.Lock()
+        self.requests = self.make_bucket(requests_per_minute)
+        self.tokens = self.make_bucket(tokens_per_minute)
+
+    @staticmethod
+    def make_bucket(per_minute):
+        if not per_minute:
+            return None
+        per_minute = per_minute * HEADROOM
+        return TokenBucket(max(1, per_minute * BURST_FRACTION), per_minute / 60)
+
+    def reserve(self, num_tokens):
+        """
+        Reserves one request and num_tokens tokens, returning the number of seconds to wait before sending it.
+        """
+        with self.lock:
+            delays = [0.0]
+            if self.requests is not None:
+                delays.append(self.requests.consume(1))
+            if self.tokens is not None:
+                delays.append(self.tokens.consume(num_tokens))
+            return max(delays)
+
+    def acquire(self, num_tokens):
+        time.sleep(self.reserve(num_tokens))
+
+    async def acquire_async(self, num_tokens):
+        await asyncio.sleep(self.reserve(num_tokens))
+
+    def settle(self, estimated_tokens, used_tokens):
+        """
+        Corrects the token budget once the actual usage of a request is known.
+        """
+        if self.tokens is None:
+            return
+        with self.lock:
+            self.tokens.refund(estimated_tokens - used_tokens)
+
+
+class RateLimiterRegistry:
+    """
+    The RateLimiter of every deployment, served by a RateLimitManager to the worker processes of a run.
+
+    Each deployment has a single budget however many processes use it, so a deployment used by one task gets its full
+    quota, and the last tasks of a run are not held to a share sized for all of them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiters = {}
+
+    def get(self, deployment, requests_per_minute, tokens_per_minute):
+        with self.lock:
+            if deployment not in self.limiters:
+                self.limiters[deployment] = RateLimiter(requests_per_minute, tokens_per_minute)
+            return self.limiters[deployment]
+
+    def reserve(self, deployment, requests_per_minute, tokens_per_minute, num_tokens):
+        return self.get(deployment, requests_per_minute, tokens_per_minute).reserve(num_tokens)
+
+    def settle(self, deployment, requests_per_minute, tokens_per_minute, estimated_tokens, used_tokens):
+        self.get(deployment, requests_per_minute, tokens_per_minute).settle(estimated_tokens, used_tokens)
+
+
+class RateLimitManager(BaseManager):
+    """
+    Server process holding the RateLimiterRegistry shared by the worker processes of run_script.
+    """
+
+
+RateLimitManager.register('RateLimiterRegistry', RateLimiterRegistry)
+
+
+class SharedRateLimiter:
+    """
+    RateLimiter interface over a deployment's budget in a shared RateLimiterRegistry.
+
+    Only the reservation goes to the manager process; the caller then sleeps in its own process or event loop.
+    """
+    def __init__(self, registry, deployment, requests_per_minute=None, tokens_per_minute=None):
+        self.registry = registry
+        self.deployment = deployment
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+    def reserve(self, num_tokens):
+        return self.registry.reserve(self.deployment, self.requests_per_minute, self.tokens_per_minute, num_tokens)
+
+    def acquire(self, num_tokens):
+        time.sleep(self.reserve(num_tokens))
+
+    async def acquire_async(self, num_tokens):
+        await asyncio.sleep(await asyncio.to_thread(self.reserve, num_tokens))
+
+    def settle(self, estimated_tokens, used_tokens):
+        self.registry.settle(self.deployment, self.requests_per_minute, self.tokens_per_minute, estimated_tokens, used_tokens)
+
+
+def get_rate_limiter(deployment, requests_per_minute=None, tokens_per_minute=None):
+    """
+    Returns the rate limiter of a deployment, creating it on first use.
+
+    Every thread that evaluates the same deployment shares one budget. When run_script has set SHARED_REGISTRY, the
+    budget is also shared with the other worker processes.
+    Returns None if no quota is given.
+    """
+    if not requests_per_minute and not tokens_per_minute:
+        return None
+    if SHARED_REGISTRY is not None:
+        return SharedRateLimiter(SHARED_REGISTRY, deployment, requests_per_minute, tokens_per_minute)
+    with RATE_LIMITERS_LOCK:
+        if deployment not in RATE_LIMITERS:
+            RATE_LIMITERS[deployment] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return RATE_LIMITERS[deployment]
@@ -1,9 +1,13 @@
 # Built-in packages
 from string import ascii_uppercase
+import inspect
 import re
+import weakref
 # External packages
 import torch
+from transformers.modeling_outputs import CausalLMOutputWithPast
 import numpy as np
+import pandas as pd
 # Local packages
 from utils.parsing_utils import remove_answer_letter
 from utils.utils import get_option_letter, normalize_dict
@@ -49,7 +53,444 @@ def normalize_probs(prob_dict):
     return [prob_dict[key] for key in sorted(prob_dict.keys())]
 
 
-def get_mc_separate(model, tokenizer, text, options, device, chat_type):
+def encode_prompt(tokenizer, text, chat_type, token_store=None):
+    """
+    Tokenizes a prompt the same way the single-question scorers do.
+
+    Parameters:
+    - tokenizer: The corresponding tokenizer for the model.
+    - text: The prompt, either a string or a list of chat messages depending on chat_type.
+    - chat_type: The chat format of the model (see reconstruct_context).
+    - token_store: An optional TokenStore of the tokenizer, looked up first and filled on a miss.
+
+    Returns:
+    - list: The token ids of the prompt, including special tokens.
+    """
+    if token_store is not None:
+        sequence = token_store.get(text)
+        if sequence is not None:
+            return sequence
+    if chat_type == 'list':
+        sequence = tokenizer.apply_chat_template(text)
+    else:
+        sequence = tokenizer.encode(text)
+    if token_store is not None:
+        token_store.put(text, sequence)
+    return sequence
+
+
+def get_option_prompts(text, options, chat_type):
+    """
+    Returns the prompts get_mc_separate scores: the question followed by each option.
+    """
+    option_prompts = []
+    for option in options:
+        if chat_type == 'list':
+            option_text = {'role': 'user', 'content': text[-1]['content'] + option}
+            option_prompts.append(text[:-1] + [option_text])
+        else:
+            option_prompts.append(f"{text} {option}")
+    return option_prompts
+
+
+def get_option_probs(logits, token_ids):
+    """
+    Reads the probabilities of a few tokens from next-token logits without a softmax over the whole vocabulary.
+
+    The log-normalizer of every row is computed once with logsumexp, and only the logits of token_ids are gathered and
+    exponentiated. Half-precision logits are upcast to float32 one row at a time for the normalizer, so no precision is
+    lost and no float32 copy of the whole batch is made.
+
+    Parameters:
+    - logits: Next-token logits of shape (batch, vocab_size).
+    - token_ids: A LongTensor of token ids, either of shape (num_tokens,) shared by every row or (batch, num_tokens).
+
+    Returns:
+    - torch.Tensor: The probabilities of token_ids of shape (batch, num_tokens), normalized over the full vocabulary.
+      Callers renormalize over the options themselves (normalize_dict), after summing the variants of each letter.
+    """
+    token_ids = token_ids.to(logits.device)
+    option_logits = (logits.index_select(-1, token_ids) if token_ids.dim() == 1 else logits.gather(-1, token_ids)).float()
+    if logits.dtype == torch.float32:
+        log_normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+    else:
+        log_normalizer = torch.stack([torch.logsumexp(row.float(), dim=-1) for row in logits]).unsqueeze(-1)
+    return (option_logits - log_normalizer).exp()
+
+
+class OptionTokenTable:
+    """
+    The token ids the option letters and option texts of a tokenizer are scored with, resolved once per tokenizer.
+
+    A letter can be produced as several single tokens, e.g. "A" and "▁A" for SentencePiece vocabularies or "A" and
+    "ĠA" for byte-level BPE. Every variant found in the vocabulary is kept, always including the token
+    tokenizer.encode(letter) starts with, and the probability of a letter is the mass of all its variants. The variant
+    ids of the first n letters are a prefix of those of the first n + 1 letters, so a single index tensor per number of
+    options, cached per device, gathers every probability in one step.
+    """
+    # Prefixes that mark a leading space in SentencePiece and byte-level BPE vocabularies
+    SPACE_MARKERS = ['', '\u2581', '\u0120']
+
+    def __init__(self, tokenizer, max_options=len(ascii_uppercase)):
+        # The tokenizer itself is not kept: it is this table's key in OPTION_TOKEN_TABLES, which must not be kept alive
+        vocab = tokenizer.get_vocab()
+        self.letter_token_ids = []
+        for letter in ascii_uppercase[:max_options]:
+            token_ids = [tokenizer.encode(letter, add_special_tokens=False)[0]]
+            for marker in self.SPACE_MARKERS:
+                token_id = vocab.get(marker + letter)
+                if token_id is not None and token_id not in token_ids:
+                    token_ids.append(token_id)
+            self.letter_token_ids.append(token_ids)
+        # End of the variants of each letter in the flat list of token ids
+        self.offsets = np.cumsum([len(token_ids) for token_ids in self.letter_token_ids]).tolist()
+        self.flat_token_ids = [token_id for token_ids in self.letter_token_ids for token_id in token_ids]
+        self.indices = {}
+        self.option_token_ids = {}
+
+    def get_token_ids(self, num_options):
+        """
+        Returns the token ids of every variant of the first num_options letters, grouped by letter.
+        """
+        return self.flat_token_ids[:self.offsets[num_options - 1]]
+
+    def get_index(self, num_options, device):
+        """
+        Returns get_token_ids(num_options) as a tensor on device, built once.
+        """
+        key = (num_options, str(device))
+        if key not in self.indices:
+            self.indices[key] = torch.tensor(self.get_token_ids(num_options), dtype=torch.long, device=device)
+        return self.indices[key]
+
+    def get_probs(self, logits, num_options):
+        """
+        Returns the probabilities of the letter variants from next-token logits of shape (batch, vocab_size), normalized
+        over the full vocabulary (see get_option_probs).
+        """
+        return get_option_probs(logits, self.get_index(num_options, logits.device))
+
+    def sum_letters(self, token_probs, num_options):
+        """
+        Sums the probabilities of the variants of each letter, given in the order of get_token_ids.
+        """
+        starts = [0] + self.offsets[:num_options - 1]
+        return [sum(token_probs[start:end]) for start, end in zip(starts, self.offsets[:num_options])]
+
+    def encode_option(self, tokenizer, option):
+        """
+        Returns the token ids of an option text encoded with tokenizer, the one this table was built from, without
+        special tokens.
+        """
+        if option not in self.option_token_ids:
+            self.option_token_ids[option] = tokenizer.encode(option, add_special_tokens=False)
+        return self.option_token_ids[option]
+
+
+OPTION_TOKEN_TABLES = weakref.WeakKeyDictionary()
+
+
+def get_option_token_table(tokenizer):
+    """
+    Returns the OptionTokenTable of a tokenizer, building it on first use.
+    """
+    if tokenizer not in OPTION_TOKEN_TABLES:
+        OPTION_TOKEN_TABLES[tokenizer] = OptionTokenTable(tokenizer)
+    return OPTION_TOKEN_TABLES[tokenizer]
+
+
+def pad_batch(model, tokenizer, sequences, device):
+    """
+    Left-pads a list of token id sequences into a batch for a single forward pass.
+
+    Left padding keeps the last real token of every row in the final position, so the next-token logits of every
+    prompt are read from the same column. Position ids are rebuilt from the attention mask so that each row sees the
+    same positions it would have seen with batch size 1.
+
+    Parameters:
+    - model: The loaded HuggingFace model.
+    - tokenizer: The corresponding tokenizer for the model.
+    - sequences: A list of lists of token ids.
+    - device: The device to place the tensors on.
+
+    Returns:
+    - dict: Keyword arguments for the model's forward pass (input_ids, attention_mask and, if supported, position_ids).
+    """
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    max_len = max(len(sequence) for sequence in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id if pad_token_id is not None else 0, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        input_ids[row, max_len - len(sequence):] = torch.tensor(sequence, dtype=torch.long)
+        attention_mask[row, max_len - len(sequence):] = 1
+
+    model_inputs = {'input_ids': input_ids.to(device), 'attention_mask': attention_mask.to(device)}
+    if 'position_ids' in inspect.signature(model.forward).parameters:
+        model_inputs['position_ids'] = (attention_mask.cumsum(-1) - 1).clamp(min=0).to(device)
+    return model_inputs
+
+
+class LengthBucketScheduler:
+    """
+    Splits the prompts of a batch into forward passes of similar length under a token budget.
+
+    Rows are sorted by token length and cut into buckets so that the padded size of every bucket (rows times its
+    longest row) stays within max_tokens_per_batch. A row longer than the budget is run on its own. Rows of one bucket
+    differ little in length, so little compute goes to padding, and the budget bounds the activation memory of a
+    forward pass. Callers write each row's result back to its original position.
+
+    The real and padded tokens of every bucket are counted, so the padding efficiency of a run can be reported.
+    """
+    def __init__(self, max_tokens_per_batch=None):
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.num_batches = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def schedule(self, lengths):
+        """
+        Returns the buckets of row indices to run together, each sorted by length.
+        """
+        buckets, bucket = [], []
+        for row in sorted(range(len(lengths)), key=lengths.__getitem__):
+            # Rows are visited in order of length, so the new row is the longest of the bucket
+            if bucket and self.max_tokens_per_batch and (len(bucket) + 1) * lengths[row] > self.max_tokens_per_batch:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(row)
+        if bucket:
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            self.num_batches += 1
+            self.real_tokens += sum(lengths[row] for row in bucket)
+            self.padded_tokens += len(bucket) * lengths[bucket[-1]]
+        return buckets
+
+    def padding_efficiency(self):
+        """
+        Returns the fraction of the scored tokens that were not padding.
+        """
+        return self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0
+
+    def stats(self):
+        return {'batches': self.num_batches, 'real_tokens': self.real_tokens, 'padded_tokens': self.padded_tokens, 'padding_efficiency': round(self.padding_efficiency(), 4)}
+
+
+# Config attributes of models that transform the output of the LM head, e.g. Gemma 2's logit soft-capping
+LOGIT_TRANSFORM_ATTRIBUTES = ['final_logit_softcapping', 'logit_scale', 'logits_scaling']
+# Tokens run through both paths to check that a model's last-token path matches its full forward pass
+PROBE_LENGTH = 8
+
+# model -> its base transformer, or None if the full forward pass has to be used
+BASE_MODELS = weakref.WeakKeyDictionary()
+
+
+def get_base_model(model):
+    """
+    Returns the transformer under a causal LM's head if the next-token logits can be computed from its last hidden state.
+
+    The head must be the module returned by get_output_embeddings(), applied to the base model's last hidden state
+    with no further transformation. This is checked once per model: a short probe is run through both paths and the
+    logits must match. Otherwise None is returned and callers fall back to the full forward pass.
+    """
+    if model in BASE_MODELS:
+        return BASE_MODELS[model]
+
+    base_model = getattr(model, getattr(model, 'base_model_prefix', ''), None)
+    output_embeddings = model.get_output_embeddings() if hasattr(model, 'get_output_embeddings') else None
+    if base_model is None or base_model is model or output_embeddings is None or any(getattr(model.config, attribute, None) for attribute in LOGIT_TRANSFORM_ATTRIBUTES):
+        BASE_MODELS[model] = None
+        return None
+
+    try:
+        input_ids = torch.arange(1, PROBE_LENGTH + 1, device=output_embeddings.weight.device).unsqueeze(0) % model.config.vocab_size
+        with torch.no_grad():
+            expected = model(input_ids).logits[:, -1, :].float()
+            actual = output_embeddings(base_model(input_ids)[0][:, -1, :]).float()
+        matches = actual.shape == expected.shape and torch.allclose(actual.cpu(), expected.cpu(), rtol=1e-3, atol=1e-3)
+    except Exception:
+        matches = False
+    BASE_MODELS[model] = base_model if matches else None
+    return BASE_MODELS[model]
+
+
+def forward_last_token(model, positions=None, **model_inputs):
+    """
+    Runs a forward pass and computes the logits of a single position per row.
+
+    The LM head of a full forward pass produces a [seq_len x vocab_size] logits tensor per row, of which the scorers
+    only read the last position. Here the base transformer is run and only the selected hidden states are projected,
+    which keeps the peak memory and time of the head independent of the prompt length. Models whose head cannot be
+    separated (see get_base_model) get the full forward pass.
+
+    Parameters:
+    - model: The loaded HuggingFace model.
+    - positions: An optional tensor with the position to read in every row. Defaults to the last one.
+    - model_inputs: The keyword arguments of the forward pass (input_ids, attention_mask, past_key_values, ...).
+
+    Returns:
+    - CausalLMOutputWithPast: logits of shape (batch, 1, vocab_size) and the past_key_values of the forward pass, so
+      outputs.logits[:, -1, :] are the requested next-token logits.
+    """
+    base_model = get_base_model(model)
+    outputs = base_model(**model_inputs) if base_model is not None else model(**model_inputs)
+    states = outputs[0] if base_model is not None else outputs.logits
+    if positions is None:
+        states = states[:, -1:, :]
+    else:
+        states = states[torch.arange(states.shape[0], device=states.device), positions.to(states.device)].unsqueeze(1)
+    logits = model.get_output_embeddings()(states) if base_model is not None else states
+    return CausalLMOutputWithPast(logits=logits, past_key_values=getattr(outputs, 'past_key_values', None))
+
+
+def forward_with_prefix_cache(model, sequence, device, prefix_cache=None, use_cache=False):
+    """
+    Runs a single prompt through the model, resuming from the longest prefix of it held in prefix_cache.
+
+    Parameters:
+    - model: The loaded HuggingFace model.
+    - sequence: A list of token ids.
+    - device: The device to place the tensors on.
+    - prefix_cache: An optional PrefixCache. The cache of the full sequence is stored in it after the forward pass.
+    - use_cache: Whether past_key_values should be returned when no prefix_cache is given.
+
+    Returns:
+    - The model outputs, with the logits of the last position only (see forward_last_token). outputs.logits[:, -1, :]
+      are the next-token logits of the full sequence.
+    """
+    if prefix_cache is None:
+        return forward_last_token(model, input_ids=torch.tensor([sequence], device=device), use_cache=use_cache)
+
+    prefix_len, past_key_values = prefix_cache.lookup(sequence)
+    outputs = forward_last_token(model, input_ids=torch.tensor([sequence[prefix_len:]], device=device), past_key_values=past_key_values, use_cache=True)
+    prefix_cache.insert(sequence, outputs.past_key_values)
+    return outputs
+
+
+def get_mc_batch(model, tokenizer, texts, options_lst, device, chat_type, logits_cache=None, token_store=None, scheduler=None):
+    """
+    Batched counterpart of get_mc: scores many independent multiple-choice prompts with one forward pass.
+
+    Parameters:
+    - model: The loaded HuggingFace model.
+    - tokenizer: The corresponding tokenizer for the model.
+    - texts: A list of MCQ prompts (strings or chat messages depending on chat_type).
+    - options_lst: A list with the options of each prompt.
+    - logits_cache: An optional LogitsCache. Only the prompts missing from it are run through the model.
+    - token_store: An optional TokenStore the prompts are tokenized through.
+    - scheduler: An optional LengthBucketScheduler splitting the prompts into forward passes of similar length.
+      Without it, all prompts are padded into a single forward pass.
+
+    Returns:
+    - list: One (answer, option_probs) tuple per prompt, in the order of texts, identical in form to the output of get_mc.
+    """
+    model.eval()
+    sequences = [encode_prompt(tokenizer, text, chat_type, token_store) for text in texts]
+    max_options = max(len(options) for options in options_lst)
+    option_table = get_option_token_table(tokenizer)
+    option_token_ids = option_table.get_token_ids(max_options)
+
+    option_token_probs = [logits_cache.get(sequence, option_token_ids) if logits_cache is not None else None for sequence in sequences]
+    missing = [row for row, token_probs in enumerate(option_token_probs) if token_probs is None]
+    if scheduler is not None:
+        buckets = [[missing[i] for i in bucket] for bucket in scheduler.schedule([len(sequences[row]) for row in missing])]
+    else:
+        buckets = [missing] if missing else []
+    for rows in buckets:
+        with torch.no_grad():
+            outputs = forward_last_token(model, **pad_batch(model, tokenizer, [sequences[row] for row in rows], device))
+
+            # Get logits of the next token for every row
+            logits = outputs.logits[:, -1, :]
+            probs = option_table.get_probs(logits, max_options)
+
+        # Results are written back by row, so the original order of the prompts is kept
+        for row, token_probs in zip(rows, probs.tolist()):
+            option_token_probs[row] = token_probs
+            if logits_cache is not None:
+                logits_cache.put(sequences[row], option_token_ids, token_probs)
+
+    responses = []
+    for row, options in enumerate(options_lst):
+        letter_probs = option_table.sum_letters(option_token_probs[row], len(options))
+        option_probs = {ascii_uppercase[i]: letter_probs[i] for i in range(len(options))}
+        responses.append((max(option_probs, key=option_probs.get), normalize_dict(option_probs)))
+    return responses
+
+
+def expand_past_key_values(past_key_values, batch_size):
+    """
+    Repeats a batch-size-1 KV cache along the batch dimension without copying it.
+
+    Parameters:
+    - past_key_values: The cache returned by a forward pass with use_cache=True, either a DynamicCache or the legacy
+      tuple of (key, value) tensors per layer.
+    - batch_size: The number of rows that will continue from the cache.
+
+    Returns:
+    - The expanded cache in the same format, or None if the model uses a cache format that cannot be expanded.
+    """
+    legacy_cache = past_key_values.to_legacy_cache() if hasattr(past_key_values, 'to_legacy_cache') else past_key_values
+    if not isinstance(legacy_cache, tuple) or not all(isinstance(tensor, torch.Tensor) for layer in legacy_cache for tensor in layer):
+        return None
+
+    expanded = tuple(tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer) for layer in legacy_cache)
+    if hasattr(past_key_values, 'from_legacy_cache'):
+        return type(past_key_values).from_legacy_cache(expanded)
+    return expanded
+
+
+def get_shared_prefix_logits(model, tokenizer, sequences, device, prefix_cache=None):
+    """
+    Computes the next-token logits at the end of each sequence, encoding the prefix shared by all sequences only once.
+
+    The shared prefix is run through the model a single time and its KV cache is reused by every sequence. The
+    remaining suffixes are right-padded and scored in one batched step, so each row keeps the positions and attention
+    it would have had on its own.
+
+    Parameters:
+    - model: The loaded HuggingFace model.
+    - tokenizer: The corresponding tokenizer for the model.
+    - sequences: A list of lists of token ids.
+    - device: The device to place the tensors on.
+    - prefix_cache: An optional PrefixCache used to resume the shared prefix from an earlier prompt.
+
+    Returns:
+    - torch.Tensor: The logits of the last token of every sequence, of shape (len(sequences), vocab_size).
+    """
+    # Longest common prefix, leaving at least one token per sequence to score
+    shared_len = 0
+    while shared_len < min(len(sequence) for sequence in sequences) - 1 and len(set(sequence[shared_len] for sequence in sequences)) == 1:
+        shared_len += 1
+
+    past_key_values = None
+    if shared_len > 0:
+        outputs = forward_with_prefix_cache(model, sequences[0][:shared_len], device, prefix_cache, use_cache=True)
+        past_key_values = expand_past_key_values(outputs.past_key_values, len(sequences))
+
+    # Fall back to one forward pass per sequence if the cache cannot be shared
+    if shared_len > 0 and past_key_values is None:
+        return torch.cat([forward_last_token(model, input_ids=torch.tensor([sequence], device=device)).logits[:, -1, :] for sequence in sequences])
+
+    suffixes = [sequence[shared_len:] for sequence in sequences]
+    max_len = max(len(suffix) for suffix in suffixes)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    input_ids = torch.full((len(suffixes), max_len), pad_token_id if pad_token_id is not None else 0, dtype=torch.long)
+    attention_mask = torch.zeros((len(suffixes), shared_len + max_len), dtype=torch.long)
+    attention_mask[:, :shared_len] = 1
+    for row, suffix in enumerate(suffixes):
+        input_ids[row, :len(suffix)] = torch.tensor(suffix, dtype=torch.long)
+        attention_mask[row, shared_len:shared_len + len(suffix)] = 1
+
+    model_inputs = {'input_ids': input_ids.to(device), 'attention_mask': attention_mask.to(device), 'past_key_values': past_key_values}
+    if 'position_ids' in inspect.signature(model.forward).parameters:
+        model_inputs['position_ids'] = torch.arange(shared_len, shared_len + max_len, device=device).unsqueeze(0).expand(len(suffixes), -1)
+    last_positions = torch.tensor([len(suffix) - 1 for suffix in suffixes])
+    return forward_last_token(model, positions=last_positions, **model_inputs).logits[:, -1, :]
+
+
+def get_mc_separate(model, tokenizer, text, options, device, chat_type, share_prefix=True, prefix_cache=None, logits_cache=None, token_store=None):
     """
     Process a multiple-choice question by appending each option letter and getting the probability.
 
@@ -58,39 +499,48 @@ def get_mc_separate(model, tokenizer, text, options, device, chat_type):
     - tokenizer: The corresponding tokenizer for the model.
     - text: The MCQ text as a string.
     - options: A list of strings representing the options.
+    - share_prefix: If True, the prompt shared by every option is encoded once and all option continuations are scored
+      from its KV cache in a single batched step. If False, every option prompt is run through the model on its own.
+    - prefix_cache: An optional PrefixCache the shared prompt is resumed from when share_prefix is True.
+    - logits_cache: An optional LogitsCache. Only the option prompts missing from it are run through the model.
+    - token_store: An optional TokenStore the option prompts are tokenized through.
 
     Returns:
     - A dict with 'responses' containing the model's output for each option,
       and 'normalized_log_odds' containing the normalized log odds of the options.
     """
     model.eval()
-    option_probs = {}
-    with torch.no_grad():
-        for option in options:
-            if chat_type == 'list':
-                option_text = {'role': 'user', 'content': text[-1]['content'] + option}
-                messages = text[:-1] + [option_text]
-                option_ids = tokenizer.apply_chat_template(messages, return_tensors="pt").to(device).input_ids
-            else:
-                option_text = f"{text} {option}"
-                option_ids = tokenizer(option_text, return_tensors="pt").to(device).input_ids
-            outputs = model(option_ids)
+    option_sequences = [encode_prompt(tokenizer, option_prompt, chat_type, token_store) for option_prompt in get_option_prompts(text, options, chat_type)]
+
+    # Option is a single character and getting its probability
+    option_table = get_option_token_table(tokenizer)
+    option_ids = [option_table.encode_option(tokenizer, option)[-1] for option in options]
 
+    option_token_probs = [logits_cache.get(sequence, [option_id]) if logits_cache is not None else None for sequence, option_id in zip(option_sequences, option_ids)]
+    missing = [row for row, token_probs in enumerate(option_token_probs) if token_probs is None]
+    if missing:
+        missing_sequences = [option_sequences[row] for row in missing]
+        with torch.no_grad():
             # Get logits of the last token produced for each option
-            logits = outputs.logits[:, -1, :]
-            probs = torch.nn.functional.softmax(logits, dim=-1)
+            if share_prefix:
+                logits = get_shared_prefix_logits(model, tokenizer, missing_sequences, device, prefix_cache)
+            else:
+                logits = torch.cat([forward_last_token(model, input_ids=torch.tensor([sequence], device=device)).logits[:, -1, :] for sequence in missing_sequences])
+            # Every row is read at the last token of its own option
+            probs = get_option_probs(logits, torch.tensor([[option_ids[row]] for row in missing]))
 
-            # Option is a single character and getting its probability
-            option_id = tokenizer.encode(option, add_special_tokens=False)[-1]
-            option_prob = probs[0, option_id]
+        for i, row in enumerate(missing):
+            option_token_probs[row] = [probs[i, 0].item()]
+            if logits_cache is not None:
+                logits_cache.put(option_sequences[row], [option_ids[row]], option_token_probs[row])
 
-            option_probs[option] = option_prob.item()
+    option_probs = {option: token_probs[0] for option, token_probs in zip(options, option_token_probs)}
     
     return max(option_probs, key=option_probs.get), normalize_dict(option_probs)
 
     
 
-def get_mc(model, tokenizer, text, options, device, chat_type):
+def get_mc(model, tokenizer, text, options, device, chat_type, prefix_cache=None, logits_cache=None, token_store=None):
     """
     Inspects the full distribution of the next tokens to select only those that are possible option letters.
 
@@ -99,33 +549,38 @@ def get_mc(model, tokenizer, text, options, device, chat_type):
     - tokenizer: The corresponding tokenizer for the model.
     - text: The MCQ text as a string.
     - options: A list of strings representing the initial tokens of the options.
+    - prefix_cache: An optional PrefixCache to resume the forward pass from the longest previously encoded prefix.
+    - logits_cache: An optional LogitsCache consulted before running the model.
+    - token_store: An optional TokenStore the prompt is tokenized through.
 
     Returns:
     - A dict with 'probabilities' containing the probability of each option's initial token,
       and 'normalized_log_odds' containing the normalized log odds of these probabilities.
     """
     model.eval()
-    with torch.no_grad():
-        # Tokenize the input text
-        if chat_type == 'list':
-            input_ids = tokenizer.apply_chat_template(text, return_tensors="pt").to(device).input_ids
-        else:
-            input_ids = tokenizer.encode(text, return_tensors="pt").to(device)
-
-        # Get the model's output
-        outputs = model(input_ids)
+    # Tokenize the input text
+    sequence = encode_prompt(tokenizer, text, chat_type, token_store)
+    # Map each option letter to the tokens it can be written as
+    option_table = get_option_token_table(tokenizer)
+    option_token_ids = option_table.get_token_ids(len(options))
+
+    option_token_probs = logits_cache.get(sequence, option_token_ids) if logits_cache is not None else None
+    if option_token_probs is None:
+        with torch.no_grad():
+            # Get the model's output
+            outputs = forward_with_prefix_cache(model, sequence, device, prefix_cache)
+
+            # Get logits of the next token
+            logits = outputs.logits[:, -1, :]
+            probs = option_table.get_probs(logits, len(options))
 
-        # Get logits of the next token
-        logits = outputs.logits[:, -1, :]
-        probs = torch.nn.functional.softmax(logits, dim=-1)
+        option_token_probs = probs[0].tolist()
+        if logits_cache is not None:
+            logits_cache.put(sequence, option_token_ids, option_token_probs)
 
-    # Map each option letter to its initial token and extract probability
-    option_probs = {}
-    # for option in options:
-    for i in range(len(options)):
-        option_token_id = tokenizer.encode(ascii_uppercase[i], add_special_tokens=False)[0]
-        option_prob = probs[0, option_token_id].item()
-        option_probs[ascii_uppercase[i]] = option_prob
+    # Extract the probability of each option letter
+    letter_probs = option_table.sum_letters(option_token_probs, len(options))
+    option_probs = {ascii_uppercase[i]: letter_probs[i] for i in range(len(options))}
 
     # print(normalize_dict(option_probs))
 
@@ -154,21 +609,22 @@ def get_mc_option(model, tokenizer, text, options, device, chat_type):
             input_ids = tokenizer.encode(text, return_tensors="pt").to(device)
 
         # Get the model's output
-        outputs = model(input_ids)
+        outputs = forward_last_token(model, input_ids=input_ids)
 
         # Get logits of the next token
         logits = outputs.logits[:, -1, :]
-        probs = torch.nn.functional.softmax(logits, dim=-1)
 
     # Map each option to its tokens and extract probability of the entire option text
+    option_table = get_option_token_table(tokenizer)
+    options_token_ids = [option_table.encode_option(tokenizer, str(option)) for option in options]
+    probs = get_option_probs(logits, torch.tensor([token_id for option_token_ids in options_token_ids for token_id in option_token_ids], dtype=torch.long))
+    probs = probs[0].tolist()
     option_probs = {}
-    for option in options:
-        if type(option) != str:
-            option = str(option)
-        option_token_ids = tokenizer.encode(option, add_special_tokens=False)
+    start = 0
+    for option_token_ids in options_token_ids:
         option_text = tokenizer.decode(option_token_ids, skip_special_tokens=True)
-        option_prob = probs[0, option_token_ids].prod().item()
-        option_probs[option_text] = option_prob
+        option_probs[option_text] = float(np.prod(probs[start:start + len(option_token_ids)]))
+        start += len(option_token_ids)
 
     return max(option_probs, key=option_probs.get), normalize_dict(option_probs)
 
@@ -225,6 +681,11 @@ HF_RESPONSE = {
     'explanation': get_explanation,
 }
 
+# Question types whose prompts can be scored many at a time
+HF_BATCH_RESPONSE = {
+    'mc': get_mc_batch,
+}
+
 #########################################################################################
 #########################################################################################
 ###                                                                                   ###
@@ -348,15 +809,15 @@ def parse_response(model_output, options_lst, question_num, return_val='PARSER_F
 #########################################################################################
 #########################################################################################
 
-def get_true_labels(question_id, answers_df):
-    return answers_df.query('question_id == @question_id')['correct_answer'].tolist()
+def get_true_labels(question_id, element_store):
+    return element_store.get_answers(question_id)
     
-def get_correct(question_id, answers_df, permuted_answer):
-    true_labels = get_true_labels(question_id, answers_df)
+def get_correct(question_id, element_store, permuted_answer):
+    true_labels = get_true_labels(question_id, element_store)
     return true_labels.index(1) == permuted_answer
 
-def get_random_acc(question_id, answers_df):
-    true_labels = get_true_labels(question_id, answers_df)
+def get_random_acc(question_id, element_store):
+    true_labels = get_true_labels(question_id, element_store)
     return sum(true_labels) / len(true_labels)
 
 def compute_ece(predicted_probs, true_labels, n_bins=10):
@@ -402,4 +863,114 @@ def compute_ece(predicted_probs, true_labels, n_bins=10):
     
     return ece
 
+def pad_ragged(rows, dtype=float):
+    """
+    Stacks rows of different lengths into a zero-padded matrix.
+
+    Returns:
+    - np.ndarray: (len(rows), max length) matrix of the rows.
+    - np.ndarray: Boolean mask of the real entries.
+    """
+    lengths = np.array([len(row) for row in rows], dtype=int)
+    matrix = np.zeros((len(rows), lengths.max() if len(rows) else 0), dtype=dtype)
+    mask = np.arange(matrix.shape[1]) < lengths[:, None]
+    if lengths.sum():
+        matrix[mask] = np.concatenate([np.asarray(row, dtype=dtype) for row in rows])
+    return matrix, mask
+
+def compute_calibration(predicted_probs, true_labels, mask=None, n_bins=10):
+    """
+    Computes the Expected Calibration Error of many questions at once, and the reliability diagram of all of them.
+
+    Every probability falls in one of n_bins equal-width bins over (0, 1] (bin i holds (i/n_bins, (i+1)/n_bins], and 0
+    falls in no bin), as in compute_ece. The per-question ECE is the value compute_ece returns for each question, and
+    the reliability diagram pools the bins of all questions, e.g. all results of a model.
+
+    Parameters:
+    - predicted_probs: (num_questions, max_options) padded matrix, or a ragged list with the probabilities of every question.
+    - true_labels: The actual labels (0 or 1), in the same layout as predicted_probs.
+    - mask (np.ndarray): Boolean mask of the real options of a padded matrix. Leave as None for ragged input.
+    - n_bins (int): The number of bins to use for grouping predicted probabilities.
+
+    Returns:
+    - np.ndarray: The ECE of every question.
+    - pd.DataFrame: One row per bin with bin_lower, bin_upper, count, confidence (mean probability) and accuracy
+      (mean label); confidence and accuracy are NaN for empty bins. Its ECE is attrs['ece'].
+    """
+    if mask is None:
+        predicted_probs, mask = pad_ragged(predicted_probs)
+        true_labels, _ = pad_ragged(true_labels)
+    predicted_probs = np.asarray(predicted_probs, dtype=float)
+    true_labels = np.asarray(true_labels, dtype=float)
+    mask = np.asarray(mask, dtype=bool)
+
+    bin_limits = np.linspace(0, 1, n_bins + 1)
+    bins = np.digitize(predicted_probs, bin_limits, right=True) - 1
+    in_bin = mask & (bins >= 0) & (bins < n_bins)
+
+    # Sums per (question, bin)
+    rows = np.broadcast_to(np.arange(len(predicted_probs))[:, None], predicted_probs.shape)
+    flat_bins = rows[in_bin] * n_bins + bins[in_bin]
+    size = len(predicted_probs) * n_bins
+    prob_sums = np.bincount(flat_bins, weights=predicted_probs[in_bin], minlength=size).reshape(-1, n_bins)
+    label_sums = np.bincount(flat_bins, weights=true_labels[in_bin], minlength=size).reshape(-1, n_bins)
+    counts = np.bincount(flat_bins, minlength=size).reshape(-1, n_bins)
+
+    # |accuracy - confidence| * bin_weight is |sum of labels - sum of probabilities| / num_options
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ece = np.abs(label_sums - prob_sums).sum(axis=1) / mask.sum(axis=1)
+
+        pooled_counts = counts.sum(axis=0)
+        reliability = pd.DataFrame({
+            'bin_lower': bin_limits[:-1],
+            'bin_upper': bin_limits[1:],
+            'count': pooled_counts,
+            'confidence': np.where(pooled_counts > 0, prob_sums.sum(axis=0) / pooled_counts, np.nan),
+            'accuracy': np.where(pooled_counts > 0, label_sums.sum(axis=0) / pooled_counts, np.nan),
+        })
+    reliability.attrs['ece'] = float(np.abs(label_sums.sum(axis=0) - prob_sums.sum(axis=0)).sum() / mask.sum()) if mask.any() else 0.0
+    return ece, reliability
+
+def compute_ece_batch(predicted_probs, true_labels, mask=None, n_bins=10):
+    """
+    Per-question ECE of compute_calibration, for callers that do not need the reliability diagram.
+    """
+    return compute_calibration(predicted_probs, true_labels, mask, n_bins)[0]
+
+def score_results(results_df, element_store):
+    """
+    Scores a frame of results against the answers of their questions in one vectorized pass.
+
+    The results need question_id, permuted_answer and option_probabilities (the probabilities in the original order of
+    the options, see convert_probabilities) columns. accuracy, normalized_accuracy and expected_calibration are
+    computed as get_correct, get_random_acc and compute_ece would for every row, and option_probabilities is dropped.
+
+    Parameters:
+    - results_df (pd.DataFrame): The unscored results.
+    - element_store (ElementStore): The elements of the task the results belong to.
+
+    Returns:
+    - pd.DataFrame: The scored results.
+    """
+    if len(results_df) == 0:
+        return results_df
+    question_ids, labels, mask = element_store.get_answer_table()
+    rows = question_ids.get_indexer(results_df['question_id'])
+    if (rows == -1).any():
+        raise KeyError(f"No answers for question_ids {results_df['question_id'][rows == -1].unique().tolist()}")
+    labels, mask = labels[rows], mask[rows]
+
+    # Pad the probabilities of every result to the options of its question
+    option_probabilities = results_df['option_probabilities'].tolist()
+    lengths = np.array([len(probabilities) for probabilities in option_probabilities])
+    predicted_probs = np.zeros(labels.shape)
+    predicted_probs[np.repeat(np.arange(len(lengths)), lengths), np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)] = np.concatenate(option_probabilities)
+
+    results_df = results_df.drop(columns='option_probabilities')
+    # The first correct option, as true_labels.index(1)
+    results_df['accuracy'] = labels.argmax(axis=1) == results_df['permuted_answer'].to_numpy()
+    results_df['normalized_accuracy'] = results_df['accuracy'] - labels.sum(axis=1) / mask.sum(axis=1)
+    results_df['expected_calibration'] = compute_ece_batch(predicted_probs, labels, mask)
+    return results_df
+
 # def get_random_acc()
\ No newline at end of file
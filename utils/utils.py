@@ -7,6 +7,8 @@ from string import ascii_uppercase
 # External packages
 import pandas as pd
 import torch
+# Local packages
+from utils.arrow_utils import has_arrow_elements, load_arrow_dfs
 
 def get_chat_type(model_name):
     if 'gpt' in model_name.lower() or 'Llama-2-7b-chat-hf' in model_name.lower() or 'Mistral-7B' in model_name.lower():
@@ -47,6 +49,9 @@ def get_gpu_memory(max_gpus=None):
 
 
 def load_dfs(filepath):
+    # Elements converted with convert_elements.py are memory-mapped instead of unpickled
+    if has_arrow_elements(filepath):
+        return load_arrow_dfs(filepath)
     return pd.read_pickle(filepath+'questions.pkl'), pd.read_pickle(filepath+'questions_metadata.pkl'), pd.read_pickle(filepath+'options.pkl'), pd.read_pickle(filepath+'answers.pkl')
 
 def flatten_list(matrix):
@@ -93,7 +98,9 @@ def write_default_config(base_dir, task_name):
             "gpt-35": {},
             "gpt-4": {}
         },
-        "output_path": f"results/{task_name}/"
+        "output_path": f"results/{task_name}/",
+        # null draws new few-shot exemplars for every question; an integer draws one cached prefix per cell
+        "prefix_seed": None
     }
 
     with open(base_dir + task_name + '.json', 'w') as f: